@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Benchmark LTX parsing, inheritance resolution, the XML loaders and the load caches,
+against a real game data tree or a generated one (see corpus.py).
+
+    python benchmarks/bench_load.py --generate 1.0 --json run.json
+    python benchmarks/bench_load.py --path ~/anomaly/unpacked/ --compare run.json
+
+Reports throughput (MB/s, sections/s), lookup latency percentiles and the peak
+memory of every phase. --compare prints each metric relative to a saved run.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from pathlib import Path
+
+# corpus.py is next to this script, and pystalker is run from the checkout
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(1, str(Path(__file__).resolve().parent.parent))
+
+from corpus import generate
+from pystalker.gamedata import StalkerGameData
+from pystalker.gamedata.ltx import LTXFileRoot, LTXParseCache, parse_ltx
+from pystalker.gamedata.string_table import StringTableGroup
+from pystalker.gamedata.texture_description import TextureDescriptionGroup
+
+# Metrics where a larger number is better, for --compare
+HIGHER_IS_BETTER = ("mb_s", "sections_s", "files_s")
+
+def tree_size(path, pattern):
+    return sum(p.stat().st_size for p in Path(path).rglob(pattern))
+
+def measure(fn):
+    """Returns (result, peak bytes allocated) of calling fn. Tracing slows it down, so it is not timed"""
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+def timed(fn):
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def best_of(repeat, fn):
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def latencies(fn, args):
+    """Per-call latency percentiles in microseconds"""
+    samples = []
+
+    for arg in args:
+        start = time.perf_counter_ns()
+        fn(arg)
+        samples.append(time.perf_counter_ns() - start)
+
+    samples.sort()
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))] / 1000
+
+    return {"p50_us": pct(50), "p90_us": pct(90), "p99_us": pct(99), "max_us": samples[-1] / 1000}
+
+def bench_ltx(gamebase, repeat, results):
+    system_ltx = gamebase / "configs" / "system.ltx"
+    ltx_bytes = tree_size(gamebase / "configs", "*.ltx")
+
+    def parse():
+        cache = LTXParseCache()
+        parse_ltx(system_ltx, cache=cache)
+        return cache
+
+    cache, peak = measure(parse)
+    elapsed = best_of(repeat, parse)
+    results["parse_ltx"] = {"seconds": elapsed, "mb_s": ltx_bytes / elapsed / 1e6,
+            "files_s": len(cache) / elapsed, "peak_mb": peak / 1e6}
+
+    def build():
+        ltx = LTXFileRoot(system_ltx)
+        ltx.parse()
+        return ltx
+
+    ltx, peak = measure(build)
+    elapsed = best_of(repeat, build)
+    results["ltx_root_parse"] = {"seconds": elapsed, "sections_s": len(ltx.section) / elapsed, "peak_mb": peak / 1e6}
+
+    # Resolving every section from cold, then again from the resolved index
+    sections = list(ltx.section.values())
+
+    def resolve_all():
+        for sec in sections:
+            sec.get_all()
+
+    def invalidate_all():
+        for sec in sections:
+            sec.invalidate()
+
+    invalidate_all()
+    _, peak = measure(resolve_all)
+    invalidate_all()
+    cold = timed(resolve_all)
+    warm = best_of(repeat, resolve_all)
+    results["resolve_get_all"] = {"cold_seconds": cold, "warm_seconds": warm,
+            "sections_s": len(sections) / warm, "peak_mb": peak / 1e6}
+
+    rng = random.Random(0)
+    probes = []
+
+    for _ in range(100000):
+        sec = rng.choice(sections)
+        keys = list(sec.resolved().keys()) or ["missing"]
+        probes.append((sec, rng.choice(keys)))
+
+    results["section_get"] = latencies(lambda probe: probe[0].get(probe[1]), probes)
+
+    return ltx
+
+def bench_xml(gamebase, repeat, results):
+    text = gamebase / "configs" / "text" / "eng"
+
+    if text.is_dir():
+        def walk():
+            stg = StringTableGroup(text)
+            stg.walk()
+            return stg
+
+        stg, peak = measure(walk)
+        elapsed = best_of(repeat, walk)
+        results["string_table_walk"] = {"seconds": elapsed, "mb_s": tree_size(text, "*.xml") / elapsed / 1e6,
+                "peak_mb": peak / 1e6}
+
+        rng = random.Random(0)
+        ids = list(stg.index)
+        probes = [rng.choice(ids) if rng.random() < 0.9 else "missing_%d" % (i) for i in range(100000)]
+        results["string_table_lookup"] = latencies(stg.lookup, probes)
+
+    textures = gamebase / "configs" / "ui" / "textures_descr"
+
+    if textures.is_dir():
+        def walk():
+            tdg = TextureDescriptionGroup(textures)
+            tdg.walk()
+            return tdg
+
+        _, peak = measure(walk)
+        elapsed = best_of(repeat, walk)
+        results["texture_description_walk"] = {"seconds": elapsed,
+                "mb_s": tree_size(textures, "*.xml") / elapsed / 1e6, "peak_mb": peak / 1e6}
+
+def cache_loads(gamebase, run):
+    """Calls run(load) for a cold load, a snapshot load and a tree cache load, in a fresh cache directory"""
+    with tempfile.TemporaryDirectory() as tmp:
+        def load():
+            gd = StalkerGameData(gamebase)
+            gd.set_cache_dir(tmp)
+            return gd.load_ini("system.ltx")
+
+        def tree_cache_load():
+            # Without the snapshot, every file comes from the tree cache
+            for path in Path(tmp).glob("*.snapshot"):
+                os.unlink(path)
+
+            return load()
+
+        return {"cold": run(load), "snapshot": run(load), "tree_cache": run(tree_cache_load)}
+
+def bench_cache(gamebase, results):
+    metrics = {}
+
+    for phase, seconds in cache_loads(gamebase, timed).items():
+        metrics[phase + "_seconds"] = seconds
+
+    for phase, (_, peak) in cache_loads(gamebase, measure).items():
+        metrics[phase + "_peak_mb"] = peak / 1e6
+
+    results["cache_load"] = metrics
+
+def compare(results, baseline):
+    print()
+    print("%-28s %-20s %12s %12s %9s" % ("benchmark", "metric", "baseline", "current", "change"))
+
+    for name, metrics in results.items():
+        for metric, current in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+
+            if not base:
+                continue
+
+            # Positive changes are always improvements
+            if metric in HIGHER_IS_BETTER:
+                change = current / base - 1
+            else:
+                change = base / current - 1
+
+            print("%-28s %-20s %12.4g %12.4g %+8.1f%%" % (name, metric, base, current, change * 100))
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--path", type=Path, help="Game data directory containing configs/")
+    source.add_argument("--generate", type=float, metavar="SCALE", help="Benchmark a generated corpus of this scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", type=Path, help="Save the results to this file")
+    parser.add_argument("--compare", type=Path, help="Compare against results saved with --json")
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(100000)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.generate is not None:
+            gamebase = Path(tmp)
+            summary = generate(gamebase, scale=args.generate, seed=args.seed)
+            print("corpus: " + ", ".join("%d %s" % (v, k) for k, v in summary.items()))
+        else:
+            gamebase = args.path
+
+        results = {}
+        bench_ltx(gamebase, args.repeat, results)
+        bench_xml(gamebase, args.repeat, results)
+        bench_cache(gamebase, results)
+
+    for name, metrics in results.items():
+        print("%-28s %s" % (name, "  ".join("%s=%.4g" % (k, v) for k, v in metrics.items())))
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({"python": sys.version.split()[0], "source": str(args.path or "generated:%g" % (args.generate)),
+                "results": results}, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp)["results"])
+
+if __name__ == "__main__":
+    main()
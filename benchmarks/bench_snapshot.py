@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare loading a built LTX section graph from a pickle of LTXFileRoot (the old
+cache format) with loading it from a snapshot.
+
+    python benchmarks/bench_snapshot.py ~/anomaly/unpacked/configs/system.ltx
+"""
+import gc
+import sys
+import time
+import pickle
+import argparse
+import tempfile
+
+from pathlib import Path
+
+# Run pystalker from the checkout
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pystalker.gamedata.ltx import LTXFileRoot
+from pystalker.gamedata.snapshot import read_snapshot, write_snapshot
+
+def best_of(repeat, fn):
+    times = []
+
+    for _ in range(repeat):
+        # The graph loaded by the previous run is cyclic garbage, don't bill its
+        # collection to whichever run happens to trigger it
+        gc.collect()
+
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ltx", type=Path, help="Root LTX file, e.g. configs/system.ltx")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # pickling a deep section graph recurses once per object
+    sys.setrecursionlimit(100000)
+
+    start = time.perf_counter()
+    ltx = LTXFileRoot(args.ltx)
+    ltx.parse()
+    print("parse: %.3fs, %d sections" % (time.perf_counter() - start, len(ltx.section)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = Path(tmp) / "ltx.pickle"
+        snapshot_path = Path(tmp) / "ltx.snapshot"
+
+        with open(pickle_path, 'wb') as fp:
+            pickle.dump(ltx, fp)
+
+        write_snapshot(ltx, snapshot_path)
+
+        def load_pickle():
+            with open(pickle_path, 'rb') as fp:
+                return pickle.load(fp)
+
+        pickle_time = best_of(args.repeat, load_pickle)
+        snapshot_time = best_of(args.repeat, lambda: read_snapshot(snapshot_path))
+
+        print("pickle:   %.3fs (%d KiB)" % (pickle_time, pickle_path.stat().st_size // 1024))
+        print("snapshot: %.3fs (%d KiB)" % (snapshot_time, snapshot_path.stat().st_size // 1024))
+        print("speedup:  %.2fx" % (pickle_time / snapshot_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Generate a deterministic synthetic game data tree shaped like Anomaly/GAMMA configs:
+thousands of LTX files pulled in by glob includes, deep and diamond inheritance, and
+large string tables and texture descriptions.
+
+    python benchmarks/corpus.py /tmp/corpus --scale 1.0 --seed 0
+
+The same seed and scale always produce byte-identical files.
+"""
+import random
+import argparse
+
+from pathlib import Path
+
+# At scale 1.0 the corpus is roughly the size of a heavily modded install
+SIZES = {
+    "item_dirs": 20,
+    "files_per_dir": 100,
+    "sections_per_file": 12,
+    "keys_per_section": 20,
+    "base_chain": 40,
+    "string_tables": 200,
+    "strings_per_table": 400,
+    "texture_files": 60,
+    "textures_per_file": 150,
+}
+
+KEY_NAMES = ["cost", "weight", "inv_name", "inv_name_short", "description", "visual",
+    "hud", "class", "ammo_class", "fire_modes", "rpm", "hit_power", "hit_impulse",
+    "condition_shot_dec", "misfire_probability", "inv_grid_x", "inv_grid_y",
+    "inv_grid_width", "inv_grid_height", "upgrades", "installed_upgrades", "slot",
+    "icon_layer", "snd_shoot", "bullet_speed", "fire_distance", "zoom_factor", "tier"]
+
+WORDS = ["anomaly", "artefact", "bandit", "duty", "freedom", "loner", "military",
+    "monolith", "stalker", "zone", "rifle", "pistol", "scope", "silencer", "ammo",
+    "medkit", "bandage", "vodka", "sausage", "detector", "outfit", "helmet", "psy"]
+
+def scaled(name, scale):
+    return max(1, int(SIZES[name] * scale))
+
+def value(rng):
+    kind = rng.random()
+
+    if kind < 0.4:
+        return str(rng.randint(0, 100000))
+    elif kind < 0.6:
+        return "%.3f" % (rng.random() * 10)
+    elif kind < 0.8:
+        return ", ".join(rng.choice(WORDS) + "_" + str(rng.randint(0, 99)) for _ in range(rng.randint(2, 6)))
+    else:
+        return "%s\\%s_%d" % (rng.choice(WORDS), rng.choice(WORDS), rng.randint(0, 999))
+
+def write_section(lines, rng, name, parents, keys):
+    if parents:
+        lines.append("[%s]:%s" % (name, ",".join(parents)))
+    else:
+        lines.append("[%s]" % (name))
+
+    for key in rng.sample(KEY_NAMES, min(keys, len(KEY_NAMES))):
+        lines.append("%-24s = %s" % (key, value(rng)))
+
+    if rng.random() < 0.2:
+        lines.append("; %s" % (" ".join(rng.choice(WORDS) for _ in range(8))))
+
+    lines.append("")
+
+def generate(root, scale=1.0, seed=0):
+    """Write a corpus under root and return a summary of what was generated"""
+    rng = random.Random(seed)
+    configs = Path(root) / "configs"
+    items = configs / "items"
+    items.mkdir(parents=True, exist_ok=True)
+
+    summary = {"ltx_files": 0, "sections": 0, "strings": 0, "textures": 0}
+
+    # A deep chain of base sections, with a few branches off every level
+    base = []
+    lines = []
+    bases = []
+
+    for i in range(scaled("base_chain", scale)):
+        name = "base_%d" % (i)
+        write_section(lines, rng, name, [bases[-1]] if bases else [], 4)
+        bases.append(name)
+
+        for j in range(3):
+            branch = "%s_%d" % (name, j)
+            write_section(lines, rng, branch, [name], 4)
+            base.append(branch)
+
+    base.extend(bases)
+    (items / "base.ltx").write_text("\n".join(lines), encoding="utf-8")
+    summary["ltx_files"] += 1
+    summary["sections"] += len(base)
+
+    system = ['#include "items\\base.ltx"']
+    dirs = scaled("item_dirs", scale)
+
+    for d in range(dirs):
+        item_dir = items / ("items_%03d" % (d))
+        item_dir.mkdir(exist_ok=True)
+        system.append('#include "items\\items_%03d\\*.ltx"' % (d))
+
+        for f in range(scaled("files_per_dir", scale)):
+            lines = []
+            local = []
+
+            for s in range(scaled("sections_per_file", scale)):
+                name = "item_%03d_%03d_%02d" % (d, f, s)
+
+                # Diamonds: two parents which share a common ancestor in the base chain
+                if local and rng.random() < 0.3:
+                    parents = [rng.choice(local), rng.choice(base)]
+                elif rng.random() < 0.3:
+                    parents = rng.sample(base, 2)
+                else:
+                    parents = [rng.choice(base)]
+
+                write_section(lines, rng, name, parents, rng.randint(1, scaled("keys_per_section", scale)))
+                local.append(name)
+
+            (item_dir / ("file_%03d.ltx" % (f))).write_text("\n".join(lines), encoding="utf-8")
+            summary["ltx_files"] += 1
+            summary["sections"] += len(local)
+
+    # A mod overriding some items after everything else
+    lines = []
+
+    for _ in range(scaled("files_per_dir", scale)):
+        name = "item_%03d_%03d_%02d" % (rng.randrange(dirs), rng.randrange(scaled("files_per_dir", scale)),
+                rng.randrange(scaled("sections_per_file", scale)))
+        write_section(lines, rng, name, [rng.choice(base)], 3)
+        summary["sections"] += 1
+
+    (items / "zz_overrides.ltx").write_text("\n".join(lines), encoding="utf-8")
+    system.append('#include "items\\zz_overrides.ltx"')
+    summary["ltx_files"] += 1
+
+    (configs / "system.ltx").write_text("\n".join(system) + "\n", encoding="utf-8")
+    summary["ltx_files"] += 1
+
+    text = configs / "text" / "eng"
+    text.mkdir(parents=True, exist_ok=True)
+
+    for t in range(scaled("string_tables", scale)):
+        lines = ['<?xml version="1.0" encoding="utf-8"?>', "<string_table>"]
+
+        for i in range(scaled("strings_per_table", scale)):
+            # Some ids are redefined by later tables
+            st_id = "st_%d_%d" % (t if rng.random() < 0.95 else rng.randrange(t + 1), i)
+            lines.append('\t<string id="%s">' % (st_id))
+            lines.append("\t\t<text>%s & %s</text>" % (" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))), rng.choice(WORDS)))
+            lines.append("\t</string>")
+
+            if rng.random() < 0.05:
+                lines.append("\t<!-- %s -->" % (rng.choice(WORDS)))
+
+        lines.append("</string_table>")
+        (text / ("st_%04d.xml" % (t))).write_text("\n".join(lines), encoding="utf-8")
+        summary["strings"] += scaled("strings_per_table", scale)
+
+    textures = configs / "ui" / "textures_descr"
+    textures.mkdir(parents=True, exist_ok=True)
+
+    for t in range(scaled("texture_files", scale)):
+        lines = ["<w>", '\t<file name="ui\\ui_icons_%d">' % (t)]
+
+        for i in range(scaled("textures_per_file", scale)):
+            lines.append('\t\t<texture id="ui_tex_%d_%d" x="%d" y="%d" width="%d" height="%d" />' %
+                    (t, i, rng.randrange(2048), rng.randrange(2048), rng.randrange(256), rng.randrange(256)))
+
+        lines.extend(["\t</file>", "</w>"])
+        (textures / ("ui_textures_%03d.xml" % (t))).write_text("\n".join(lines), encoding="utf-8")
+        summary["textures"] += scaled("textures_per_file", scale)
+
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", type=Path, help="Directory to generate the game data tree in")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate(args.root, scale=args.scale, seed=args.seed)
+    print(", ".join("%d %s" % (v, k) for k, v in summary.items()))
+
+if __name__ == "__main__":
+    main()
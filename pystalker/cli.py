@@ -1,59 +1,86 @@
 #!/usr/bin/env python3
-import re
 import sys
+import hashlib
 import logging
 import json
 import argparse
 import readline
 
 from pathlib import Path
-from fnmatch import fnmatch
 
-from pystalker.gamedata import StalkerGameData
+from pystalker.commands import QueryHandler
+from pystalker.completion import SectionCompleter
+from pystalker.server import QueryServer, query_server
+from pystalker.gamedata import StalkerGameData, LoadStats, LayeredFS
+from pystalker.gamedata.diff import diff_ltx
+from pystalker.gamedata.export import FORMATS, export
 
 log = logging.getLogger(__name__)
 
 class CompletionState:
     MAX_COMPLETION = 100
 
-    def __init__(self, ltx, st):
+    def __init__(self, ltx, st, fuzzy=False):
         self.ltx = ltx
         self.st = st
-        self.top_level = list(ltx.section.keys())
+        self.completer = SectionCompleter(ltx, all_keys=True, fuzzy=fuzzy)
         self._cached_lookup = None
-        self._all_keys = True
 
     def get_section_keys(self, sect):
-        if sect not in self.ltx.section:
-            return []
-
-        if self._all_keys:
-            keys = self.ltx.section[sect].get_all().keys()
-        else:
-            keys = self.ltx.section[sect].keys.keys()
-
-        return keys
+        keys = self.completer.section_keys(sect)
+        return keys.words if keys is not None else []
 
     def complete(self, text, state):
-        access_prop = text.find('.')
-        if access_prop == -1:
-            if state == 0:
-                self._cached_lookup = list(filter(lambda x: x.startswith(text), self.top_level))
-        else:
-            top_level = text[:access_prop]
-            prop = text[access_prop+1:]
+        if state == 0:
+            self._cached_lookup = self.completer.complete(text, self.MAX_COMPLETION)
 
-            if state == 0:
-                keys = self.get_section_keys(top_level)
-                self._cached_lookup = list(map(lambda x: f'{top_level}.{x}', filter(lambda x: x.startswith(prop), keys)))
-
-        if state >= len(self._cached_lookup) or state >= self.MAX_COMPLETION:
+        if state >= len(self._cached_lookup):
             return
 
         return self._cached_lookup[state]
 
-def explore(ltx, st):
-    comp = CompletionState(ltx, st)
+def print_result(handler, query, result, print_st_key):
+    """Print the result of a QueryHandler query as text"""
+    if not query.startswith("!"):
+        print(handler.ltx.section[result["section"]])
+
+        if "keys" in result and "parents" not in result:
+            for k, v in result["keys"].items():
+                print("%s = %s" % (k, print_st_key(v)))
+        elif "key" in result:
+            print("%s = %s" % (result["key"], print_st_key(result["value"])))
+
+        return
+
+    cmd = query[1:].split()[0]
+
+    if cmd == "info":
+        print("Parents:")
+        for parent in result["parents"]:
+            print(" - %s" % (parent))
+
+        for title, field in (("Class", "class"), ("Kind", "kind")):
+            if result[field]:
+                print("%s:" % (title))
+                for value, sec in result[field]:
+                    print(" - %s (%s)" % (value, sec))
+    elif cmd == "xref":
+        print(result["referrers"])
+    elif cmd == "st":
+        print(result["text"])
+    elif "sections" in result:
+        for k in result["sections"]:
+            print(k)
+    elif "counts" in result:
+        for i, (v, count) in enumerate(result["counts"]):
+            print("%d. '%s' (%d)" % (i+1, v, count))
+    elif "count" in result:
+        print(result["count"])
+
+def explore(handler, fuzzy=False):
+    """Interactive prompt answering the queries of a QueryHandler"""
+    comp = CompletionState(handler.ltx, handler.st, fuzzy=fuzzy)
+    st = handler.st
 
     def completer(*args):
         return comp.complete(*args)
@@ -75,27 +102,6 @@ def explore(ltx, st):
         else:
             return "%s // MISSING" % (k)
 
-    xrefs = {}
-    xrefs.update({k: set() for k in ltx.section.keys()})
-
-    for t in st.table.values():
-        xrefs.update({k: set() for k in t.entry.keys()})
-
-    print("Building xrefs...")
-    for sect_name, sect in ltx.section.items():
-        for parent in sect.parents:
-            xrefs[parent.name].add(sect_name)
-
-        for k, v in sect.get_all().items():
-            if isinstance(v, list):
-                for val in v:
-                    if val in xrefs:
-                        xrefs[val].add(sect_name)
-
-            elif isinstance(v, str):
-                if v in xrefs:
-                    xrefs[v].add(sect_name)
-
     while True:
         try:
             query = input("> ")
@@ -113,130 +119,217 @@ def explore(ltx, st):
         if query == "exit" or query == "quit":
             break
 
-        if query.startswith("!"):
-            bang_argv = list(filter(lambda x: len(x.strip()) > 0, query[1:].split(" ")))
-            bang_cmd = bang_argv[0]
-            bang_argv = bang_argv[1:]
-
-            #print(bang_cmd, bang_argv)
-            if bang_cmd == "xref":
-                if len(bang_argv) != 1:
-                    print("error: xref requires arg")
-                    continue
-                xref_query = bang_argv[0]
-
-                if xref_query not in xrefs:
-                    print("error: non tracked key")
-                    continue
-
-                print(xrefs[xref_query])
-            elif bang_cmd == "info":
-                if len(bang_argv) != 1:
-                    print("error: section required")
-                    continue
-
-                section_name = bang_argv[0]
-
-                section = ltx.section.get(section_name)
-                if section is None:
-                    print("error: unknown section %s" % (query))
-                    continue
-
-                print("Parents:")
-                for parent in section.parents:
-                    print(" - %s" % (parent))
-
-                classes = section.get_key_hier("class")
-                if classes:
-                    print("Class:")
-                    for cls, sec in classes:
-                        print(" - %s (%s)" % (cls, sec.name))
-
-                kind = section.get_key_hier("kind")
-                if kind:
-                    print("Kind:")
-                    for kind, sec in kind:
-                        print(" - %s (%s)" % (kind, sec.name))
-
-            elif bang_cmd == "search_sec":
-                if len(bang_argv) != 1:
-                    print("error: search_sec requires arg")
-                    continue
-
-                search_query = bang_argv[0]
-
-                for k in filter(lambda x: fnmatch(x, search_query), ltx.section.keys()):
-                    print(k)
-            elif bang_cmd == "agg":
-                if len(bang_argv) != 2:
-                    print("error: agg section_pat field")
-                    continue
-
-                section_pat = bang_argv[0]
-                field_name = bang_argv[1]
-
-                results = {}
-
-                for k in filter(lambda x: fnmatch(x, section_pat), ltx.section.keys()):
-                    v = ltx.section[k].get(field_name)
-                    if v is not None:
-                        if isinstance(v, list):
-                            v = ",".join(v)
-
-                        results[v] = results.get(v, 0) + 1
-
-                for i, (v, count) in enumerate(sorted(results.items(), key=lambda x: x[1], reverse=True)):
-                    print("%d. '%s' (%d)" % (i+1, v, count))
-            else:
-                print("error: unknown command %s" % (bang_cmd))
+        response = handler.run(query)
+
+        if "error" in response:
+            print("error: %s" % (response["error"]))
+        else:
+            print_result(handler, query, response["result"], print_st_key)
 
+def batch(handler, fp_in, fp_out):
+    """Answer one query per line of fp_in with one JSON object per line on fp_out"""
+    for line in fp_in:
+        query = line.strip()
+
+        if query == "" or query.startswith("#"):
             continue
 
-        access_prop = query.find('.')
+        fp_out.write(json.dumps(handler.run(query)) + "\n")
+        fp_out.flush()
 
-        if access_prop == -1:
-            section_name = query
-            prop = None
-        else:
-            section_name = query[:access_prop]
-            prop = query[access_prop+1:]
+def game_data_root(args):
+    """The --path directory, or a LayeredFS of it and the mod folders layered over it"""
+    if args.modlist:
+        fs = LayeredFS.from_mo2(args.path, args.mods_dir or Path(args.modlist).parent.parent.parent / "mods", args.modlist)
+        fs.roots.extend(map(Path, args.overlay))
+        return fs
+    elif args.overlay:
+        return LayeredFS([args.path] + args.overlay)
 
-        section = ltx.section.get(section_name)
-        if section is None:
-            print("error: unknown section %s" % (query))
-            continue
+    return Path(args.path)
 
-        print(section)
-        if prop:
-            if '*' in prop:
-                for k in filter(lambda x: fnmatch(x, prop), comp.get_section_keys(section_name)):
-                    print("%s = %s" % (k, print_st_key(section.get(k))))
-            elif not section.has(prop):
-                print("error: missing property %s" % (prop))
-            else:
-                print("%s = %s" % (prop, print_st_key(section.get(prop))))
+def load_game_data(args):
+    GD = StalkerGameData(game_data_root(args))
 
-def main():
-    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    if not args.no_cache:
+        args.cache_dir.mkdir(exist_ok=True)
+        GD.set_cache_dir(args.cache_dir)
+
+    if args.compact:
+        GD.set_compact()
+
+    if args.stats:
+        stats = LoadStats(trace_memory=True)
+        GD.set_stats(stats)
+
+    ltx = GD.ini_sys()
+    st = GD.string_table()
+
+    if args.compact:
+        log.info("LTX sections use %.1f MiB", ltx.memory_footprint() / (1024*1024))
+
+    if args.stats:
+        GD.set_stats(None)
+        print(stats.report(), file=sys.stderr)
+
+    return GD, ltx, st
+
+def diff(args):
+    trees = []
+
+    for path in (args.old, args.new):
+        GD = StalkerGameData(Path(path))
 
+        if not args.no_cache:
+            # Each tree keeps its snapshot in a cache directory of its own
+            cache_dir = args.cache_dir / ("diff_" + hashlib.md5(str(Path(path).resolve()).encode("utf-8")).hexdigest()[:12])
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            GD.set_cache_dir(cache_dir)
+
+        if args.compact:
+            GD.set_compact()
+
+        trees.append(GD.ini_sys())
+
+    result = diff_ltx(*trees)
+
+    if args.json:
+        print(json.dumps(result.as_dict(), ensure_ascii=False))
+    else:
+        for line in result.lines():
+            print(line)
+
+    sys.exit(1 if result else 0)
+
+def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--path", required=True, help="Path to unpacked STALKER DB directory")
+    parser.add_argument("--path", help="Path to unpacked STALKER DB directory")
+    parser.add_argument("--overlay", action="append", default=[],
+            help="A mod directory layered over --path, overriding its files. May be repeated, later ones win")
+    parser.add_argument("--modlist", help="Layer the enabled mods of a Mod Organizer profile's modlist.txt over --path")
+    parser.add_argument("--mods-dir", help="Mod Organizer mods directory (default: the mods directory of the --modlist instance)")
     parser.add_argument("--cache-dir", default=Path("./.cache/"), type=Path)
     parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--compact", action="store_true", help="Reduce the memory held by loaded LTX sections")
+    parser.add_argument("--stats", action="store_true",
+            help="Print load timings, the slowest files and memory per phase (tracing memory slows loading)")
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command",
+            help="explore (the default), batch, export, diff, serve or client")
+
+    explore_parser = subparsers.add_parser("explore", help="Interactively explore the LTX sections")
+    explore_parser.add_argument("--fuzzy", action="store_true", help="Fall back to substring/fuzzy matches when completing")
+
+    batch_parser = subparsers.add_parser("batch", help="Answer queries read one per line as JSON Lines")
+    batch_parser.add_argument("--input", "-i", default="-", help="Query file, or - for stdin")
+    batch_parser.add_argument("--output", "-o", default="-", help="Output file, or - for stdout")
+
+    export_parser = subparsers.add_parser("export", help="Write every resolved section as JSON Lines or CSV")
+    export_parser.add_argument("--format", "-f", choices=FORMATS, default="jsonl")
+    export_parser.add_argument("--output", "-o", default="-", help="Output file, or - for stdout")
+    export_parser.add_argument("--sections", "-s", help="Only export sections whose name matches this glob")
+    export_parser.add_argument("--keys", "-k", help="Only export keys matching these comma separated globs")
+    export_parser.add_argument("--workers", "-j", type=int,
+            help="Format sections in this many processes (0 for one per CPU). Requires the cache")
+
+    diff_parser = subparsers.add_parser("diff", help="Report the sections and keys which changed between two game data trees")
+    diff_parser.add_argument("old", help="Path to the old unpacked STALKER DB directory")
+    diff_parser.add_argument("new", help="Path to the new unpacked STALKER DB directory")
+    diff_parser.add_argument("--json", action="store_true", help="Print the diff as JSON")
+
+    serve_parser = subparsers.add_parser("serve", help="Keep the game data loaded and answer queries on a Unix socket")
+    serve_parser.add_argument("--socket", type=Path, help="Socket path (default: pystalker.sock in the cache directory)")
+    serve_parser.add_argument("--watch", action="store_true", help="Reload when the game data changes")
+    serve_parser.add_argument("--interval", type=float, default=2.0, help="Seconds between checks for changes")
+
+    client_parser = subparsers.add_parser("client", help="Send queries to a running server, printing JSON Lines")
+    client_parser.add_argument("--socket", type=Path, help="Socket path (default: pystalker.sock in the cache directory)")
+    client_parser.add_argument("queries", nargs="*", help="Queries to send, otherwise read one per line from stdin")
 
     args = parser.parse_args()
+    command = args.command or "explore"
 
-    gamebase = Path(args.path)
-    GD = StalkerGameData(gamebase)
+    if command in ("serve", "client") and args.socket is None:
+        args.socket = args.cache_dir / "pystalker.sock"
 
-    if not args.no_cache:
-        args.cache_dir.mkdir(exist_ok=True)
-        GD.set_cache_dir(args.cache_dir)
+    if command == "client":
+        try:
+            for response in query_server(args.socket, args.queries or sys.stdin):
+                print(response, flush=True)
+        except OSError as e:
+            print("error: unable to query server on %s: %s" % (args.socket, e), file=sys.stderr)
+            sys.exit(1)
 
-    ltx = GD.ini_sys()
-    st = GD.string_table()
+        return
+
+    if command == "diff":
+        logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+        diff(args)
+        return
+
+    if args.path is None:
+        parser.error("%s requires --path" % (command))
+
+    # batch and export write their results to stdout, so keep the log out of it
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr if command in ("batch", "export") else sys.stdout)
+
+    if command == "export":
+        GD = StalkerGameData(game_data_root(args))
+
+        if not args.no_cache:
+            args.cache_dir.mkdir(exist_ok=True)
+            GD.set_cache_dir(args.cache_dir)
+
+        ltx = GD.ini_sys()
+        keys = [k.strip() for k in args.keys.split(",")] if args.keys else None
+        fp_out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+
+        try:
+            count = export(ltx, fp_out, fmt=args.format, sections=args.sections, keys=keys,
+                    workers=args.workers, snapshot_path=GD.fresh_snapshot_path())
+        finally:
+            if fp_out is not sys.stdout:
+                fp_out.close()
+
+        log.info("Exported %d sections", count)
+        return
+
+    if command == "serve":
+        def load():
+            GD, ltx, st = load_game_data(args)
+            return QueryHandler(ltx, st, GD.xref_index(), GD.query_engine())
+
+        args.socket.parent.mkdir(parents=True, exist_ok=True)
+        root = game_data_root(args)
+        roots = root.roots if isinstance(root, LayeredFS) else [root]
+        watch = [Path(r) / "configs" for r in roots] if args.watch else None
+        try:
+            QueryServer(load, args.socket, watch=watch, interval=args.interval).run()
+        except OSError as e:
+            log.error("Unable to serve on %s: %s", args.socket, e)
+            sys.exit(1)
+
+        return
+
+    GD, ltx, st = load_game_data(args)
+
+    handler = QueryHandler(ltx, st, GD.xref_index(), GD.query_engine())
+
+    if command == "batch":
+        fp_in = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+        fp_out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+
+        try:
+            batch(handler, fp_in, fp_out)
+        finally:
+            if fp_in is not sys.stdin:
+                fp_in.close()
+            if fp_out is not sys.stdout:
+                fp_out.close()
+
+        return
 
-    explore(ltx, st)
+    explore(handler, fuzzy=getattr(args, "fuzzy", False))
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,161 @@
+import re
+import logging
+
+from fnmatch import fnmatch
+
+from pystalker.gamedata import XrefIndex, LTXQueryEngine, LTXQueryError
+
+log = logging.getLogger(__name__)
+
+"""
+The queries understood by the explorer, the batch mode and the query server, returning plain
+data which can be serialized as JSON (the explorer prints it as text instead):
+
+    section             every resolved key of a section
+    section.key         one key, or several with a glob (section.use*)
+    !info section       parents, class and kind
+    !xref value         sections referencing a section, string id or value
+    !search_sec pattern section names matching a glob
+    !agg pattern key    counts of the values of key over the sections matching pattern
+    !query predicate    sections matching a predicate (see pystalker.gamedata.query)
+    !count predicate [by key]
+    !st id              the text of a string table id
+"""
+
+class QueryError(Exception):
+    pass
+
+class QueryHandler:
+    def __init__(self, ltx, st, xrefs=None, engine=None):
+        self.ltx = ltx
+        self.st = st
+        self.xrefs = xrefs if xrefs is not None else XrefIndex(ltx).build()
+        self.engine = engine if engine is not None else LTXQueryEngine(ltx)
+
+    def run(self, query):
+        """Returns {"query": query, "result": ...}, or {"query": query, "error": message} if it failed"""
+        try:
+            return {"query": query, "result": self.handle(query)}
+        except (QueryError, LTXQueryError) as e:
+            return {"query": query, "error": str(e)}
+
+    def handle(self, query):
+        query = query.strip()
+
+        if query == "":
+            raise QueryError("empty query")
+
+        if query.startswith("!"):
+            argv = query[1:].split()
+
+            if not argv:
+                raise QueryError("command required")
+
+            cmd = argv[0]
+            handler = getattr(self, "cmd_" + cmd, None)
+
+            if handler is None:
+                raise QueryError("unknown command %s" % (cmd))
+
+            # The raw text after the command, e.g. a query expression with its own spacing
+            rest = query[1:].strip().split(None, 1)[1:]
+
+            return handler(argv[1:], rest[0] if rest else "")
+
+        return self.lookup(query)
+
+    def section(self, name):
+        section = self.ltx.section.get(name)
+
+        if section is None:
+            raise QueryError("unknown section %s" % (name))
+
+        return section
+
+    def lookup(self, query):
+        access_prop = query.find('.')
+
+        if access_prop == -1:
+            section = self.section(query)
+
+            return {
+                "section": section.name,
+                "parents": [parent.name for parent in section.parents],
+                "file": str(section.defined_in.path) if section.defined_in else None,
+                "keys": section.get_all(),
+            }
+
+        section = self.section(query[:access_prop])
+        prop = query[access_prop+1:]
+
+        if '*' in prop:
+            keys = section.get_all_view()
+            return {
+                "section": section.name,
+                "keys": {k: section.get(k) for k in keys if fnmatch(str(k), prop)},
+            }
+
+        if not section.has(prop):
+            raise QueryError("missing property %s" % (prop))
+
+        return {"section": section.name, "key": prop, "value": section.get(prop)}
+
+    def cmd_info(self, argv, rest):
+        if len(argv) != 1:
+            raise QueryError("section required")
+
+        section = self.section(argv[0])
+
+        return {
+            "section": section.name,
+            "parents": [parent.name for parent in section.parents],
+            "class": [[cls, sec.name] for cls, sec in section.get_key_hier("class")],
+            "kind": [[kind, sec.name] for kind, sec in section.get_key_hier("kind")],
+        }
+
+    def cmd_xref(self, argv, rest):
+        if len(argv) != 1:
+            raise QueryError("xref requires arg")
+
+        target = argv[0]
+
+        if target not in self.xrefs and target not in self.ltx.section and target not in self.st:
+            raise QueryError("non tracked key")
+
+        return {"referrers": sorted(self.xrefs.referrers(target))}
+
+    def cmd_search_sec(self, argv, rest):
+        if len(argv) != 1:
+            raise QueryError("search_sec requires arg")
+
+        return {"sections": self.engine.select_names(argv[0])}
+
+    def cmd_agg(self, argv, rest):
+        if len(argv) != 2:
+            raise QueryError("agg section_pat field")
+
+        return {"counts": self.engine.count(group_by=argv[1], names=self.engine.select_names(argv[0]))}
+
+    def cmd_query(self, argv, rest):
+        if not rest:
+            raise QueryError("query predicate")
+
+        return {"sections": self.engine.select(rest)}
+
+    def cmd_count(self, argv, rest):
+        if not rest:
+            raise QueryError("count predicate [by field]")
+
+        m = re.match(r"(.*)\s+by\s+(\S+)$", rest)
+
+        if m is None:
+            return {"count": self.engine.count(rest)}
+
+        predicate, group_by = m.groups()
+        return {"counts": self.engine.count(predicate, group_by=group_by)}
+
+    def cmd_st(self, argv, rest):
+        if len(argv) != 1:
+            raise QueryError("st requires a string id")
+
+        return {"id": argv[0], "text": self.st.lookup(argv[0])}
@@ -0,0 +1,113 @@
+import logging
+
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+class CompletionIndex:
+    """
+    Prefix completion over a fixed set of words, using bisect over a sorted list.
+
+    With fuzzy, a prefix which matches nothing falls back to substring matches (earliest
+    and shortest first), then to words containing the characters of the text in order.
+    """
+    def __init__(self, words, fuzzy=False):
+        self.words = sorted(set(words))
+        self.fuzzy = fuzzy
+
+    def prefix_range(self, prefix):
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix + "\U0010ffff", start)
+        return start, end
+
+    def complete(self, text, limit=None):
+        start, end = self.prefix_range(text)
+
+        if limit is not None:
+            end = min(end, start + limit)
+
+        if start < end or not self.fuzzy or not text:
+            return self.words[start:end]
+
+        return self.search(text, limit)
+
+    def search(self, text, limit=None):
+        """Rank the words which contain text, or failing that, its characters in order"""
+        matches = []
+
+        for word in self.words:
+            pos = word.find(text)
+
+            if pos != -1:
+                matches.append((pos, len(word), word))
+
+        if not matches:
+            for word in self.words:
+                span = self._subsequence_span(word, text)
+
+                if span is not None:
+                    matches.append((span, len(word), word))
+
+        matches.sort()
+        return [word for _, _, word in matches[:limit]]
+
+    @staticmethod
+    def _subsequence_span(word, text):
+        # the length of the shortest prefix of word containing text in order, or None
+        pos = -1
+
+        for c in text:
+            pos = word.find(c, pos + 1)
+
+            if pos == -1:
+                return None
+
+        return pos
+
+    def __len__(self):
+        return len(self.words)
+
+    def __repr__(self):
+        return "<CompletionIndex %d words>" % (len(self.words))
+
+class SectionCompleter:
+    """
+    Completes "section" and "section.key" for the explorer.
+
+    The section name index is built once. Each section's key list is built the first
+    time it is completed and kept, as sections do not change while exploring.
+    """
+    def __init__(self, ltx, all_keys=True, fuzzy=False):
+        self.ltx = ltx
+        self.all_keys = all_keys
+        self.fuzzy = fuzzy
+        self.sections = CompletionIndex(ltx.section.keys(), fuzzy=fuzzy)
+        self._keys = {}
+
+    def section_keys(self, name):
+        index = self._keys.get(name)
+
+        if index is None:
+            section = self.ltx.section.get(name)
+
+            if section is None:
+                return None
+
+            keys = section.get_all_view().keys() if self.all_keys else section.keys.keys()
+            index = self._keys[name] = CompletionIndex(map(str, keys), fuzzy=self.fuzzy)
+
+        return index
+
+    def complete(self, text, limit=None):
+        access_prop = text.find('.')
+
+        if access_prop == -1:
+            return self.sections.complete(text, limit)
+
+        name = text[:access_prop]
+        keys = self.section_keys(name)
+
+        if keys is None:
+            return []
+
+        return ["%s.%s" % (name, key) for key in keys.complete(text[access_prop+1:], limit)]
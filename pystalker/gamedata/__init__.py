@@ -1 +1,6 @@
 from .manager import StalkerGameData
+from .xref import XrefIndex
+from .query import LTXQueryEngine, LTXQueryError, parse_query
+from .section_index import LTXSectionIndex
+from .stats import LoadStats
+from .vfs import LayeredFS
@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import pickle
+
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+class FileCache:
+    """
+    A persistent cache of per-file parse results.
+
+    The parser is only needed for get(). Callers which parse files themselves
+    (for instance concurrently) can use lookup() and put() instead.
+
+    The manifest records the mtime, size and MD5 of every file parsed through the cache.
+    A cached result is reused when the mtime and size are unchanged, or failing that, when
+    the content hash still matches. Only files which really changed are handed to the parser.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_path, parser=None):
+        self.cache_path = Path(cache_path)
+        self.parser = parser
+        self.entries = {}
+        self.touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def load(self):
+        if not self.cache_path.exists():
+            return
+
+        try:
+            with open(self.cache_path, 'rb') as fp:
+                data = pickle.load(fp)
+        except Exception as e:
+            log.warning("Discarding unreadable cache %s: %s", self.cache_path, e)
+            return
+
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            log.info("Discarding cache %s from a different version", self.cache_path)
+            return
+
+        self.entries = data["entries"]
+
+    def save(self):
+        # Files no longer reached by the walk are dropped from the manifest
+        if not self.dirty and self.touched.keys() == self.entries.keys():
+            return
+
+        tmp_path = self.cache_path.with_name(self.cache_path.name + ".tmp")
+
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump({"version": self.VERSION, "entries": self.touched}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, self.cache_path)
+        self.entries = dict(self.touched)
+        self.dirty = False
+
+    def manifest(self):
+        """Returns {path: (mtime_ns, size, md5)} for every file requested so far"""
+        return {path: entry[:3] for path, entry in self.touched.items()}
+
+    def lookup(self, path):
+        """Returns the cached result for path if it is still fresh, otherwise None"""
+        path = Path(path)
+        key = str(path)
+
+        entry = self.touched.get(key)
+        if entry is not None:
+            return entry[3]
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        st = path.stat()
+        mtime, size, digest, result = entry
+
+        if mtime == st.st_mtime_ns and size == st.st_size:
+            self.hits += 1
+            self.touched[key] = entry
+            return result
+
+        if size == st.st_size and digest == self.hash_file(path):
+            self.hits += 1
+            self.touched[key] = (st.st_mtime_ns, st.st_size, digest, result)
+            self.dirty = True
+            return result
+
+        return None
+
+    def put(self, path, result):
+        path = Path(path)
+        st = path.stat()
+
+        self.misses += 1
+        self.touched[str(path)] = (st.st_mtime_ns, st.st_size, self.hash_file(path), result)
+        self.dirty = True
+
+    def get(self, path):
+        result = self.lookup(path)
+
+        if result is None:
+            result = self.parser(path)
+            self.put(path, result)
+
+        return result
+
+    @staticmethod
+    def hash_file(path):
+        with open(path, 'rb') as fp:
+            return hashlib.md5(fp.read()).hexdigest()
+
+    def __repr__(self):
+        return "<FileCache %s, files=%d, hits=%d, misses=%d>" % \
+                (self.cache_path.name, len(self.touched), self.hits, self.misses)
@@ -1,6 +1,13 @@
 import xml.etree.ElementTree as ET
 
-def parse_color_map(path):
+def parse_color_map(path, cache=None):
+    """Parse a color definition file, reusing the result from a FileCache if it is unchanged"""
+    if cache is not None:
+        cmap = cache.lookup(path)
+
+        if cmap is not None:
+            return cmap
+
     tree = ET.parse(path)
     root = tree.getroot()
 
@@ -13,4 +20,7 @@ def parse_color_map(path):
             c.attrib.get('a', 255)
         )
 
+    if cache is not None:
+        cache.put(path, cmap)
+
     return cmap
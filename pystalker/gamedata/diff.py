@@ -0,0 +1,130 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+"""
+Structural diff between the resolved sections of two LTXFileRoots.
+
+Sections present in both are first compared by fingerprint (see LTXSection.fingerprint).
+Only those whose fingerprints differ are resolved and compared key by key, so the cost
+beyond hashing is proportional to what changed.
+"""
+
+_MISSING = object()
+
+class SectionDiff:
+    """The key changes of one section: added and removed {key: value}, changed {key: (old, new)}"""
+    def __init__(self, name):
+        self.name = name
+        self.added = {}
+        self.removed = {}
+        self.changed = {}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def as_dict(self):
+        return {
+            "section": self.name,
+            "added": self.added,
+            "removed": self.removed,
+            "changed": {key: list(change) for key, change in self.changed.items()},
+        }
+
+    def __repr__(self):
+        return "<SectionDiff %s, +%d -%d ~%d>" % (self.name, len(self.added), len(self.removed), len(self.changed))
+
+class LTXDiff:
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        # Sections with different fingerprints which still resolve to the same keys
+        self.unchanged_rehashed = 0
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def as_dict(self):
+        return {
+            "added": self.added,
+            "removed": self.removed,
+            "changed": [sec.as_dict() for sec in self.changed],
+        }
+
+    def lines(self):
+        """Yields the diff as text, one line at a time"""
+        for name in self.added:
+            yield "+ [%s]" % (name)
+
+        for name in self.removed:
+            yield "- [%s]" % (name)
+
+        for sec in self.changed:
+            yield "~ [%s]" % (sec.name)
+
+            for key, value in sec.added.items():
+                yield "    + %s = %s" % (key, value)
+
+            for key, value in sec.removed.items():
+                yield "    - %s = %s" % (key, value)
+
+            for key, (old, new) in sec.changed.items():
+                yield "    ~ %s = %s -> %s" % (key, old, new)
+
+    def __repr__(self):
+        return "<LTXDiff +%d -%d ~%d>" % (len(self.added), len(self.removed), len(self.changed))
+
+def _value(value):
+    return list(value) if isinstance(value, tuple) else value
+
+def diff_sections(name, old, new):
+    """Compare the resolved keys of two sections"""
+    result = SectionDiff(name)
+    old_keys = old.resolved()
+    new_keys = new.resolved()
+
+    for key, value in new_keys.items():
+        old_value = old_keys.get(key, _MISSING)
+
+        if old_value is _MISSING:
+            result.added[key] = _value(value)
+        elif old_value != value:
+            result.changed[key] = (_value(old_value), _value(value))
+
+    for key, value in old_keys.items():
+        if key not in new_keys:
+            result.removed[key] = _value(value)
+
+    return result
+
+def diff_ltx(old, new):
+    """Returns an LTXDiff of the sections of new against those of old, in load order"""
+    result = LTXDiff()
+    old_sections = old.section
+    new_sections = new.section
+
+    for name in new_sections:
+        if name not in old_sections:
+            result.added.append(name)
+            continue
+
+        old_sec = old_sections[name]
+        new_sec = new_sections[name]
+
+        if old_sec.fingerprint() == new_sec.fingerprint():
+            continue
+
+        changes = diff_sections(name, old_sec, new_sec)
+
+        if changes:
+            result.changed.append(changes)
+        else:
+            result.unchanged_rehashed += 1
+
+    result.removed = [name for name in old_sections if name not in new_sections]
+
+    log.info("Diff: %d added, %d removed, %d changed, %d rehashed without changes", len(result.added),
+            len(result.removed), len(result.changed), result.unchanged_rehashed)
+
+    return result
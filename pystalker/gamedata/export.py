@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+import logging
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from itertools import islice
+
+from .snapshot import open_snapshot
+
+log = logging.getLogger(__name__)
+
+"""
+Streaming export of resolved sections, one record per section:
+
+    {"section": name, "file": defining file, "parents": direct parents,
+     "chain": every ancestor in lookup order, "keys": {key: value, ...}}
+
+as JSON Lines, or as CSV with one (section, file, parents, key, value) row per key.
+Records are generated one at a time and the resolved index built for each exported
+section is dropped again (only ancestors keep theirs), so memory stays flat however
+large the config is.
+"""
+
+FORMATS = ("jsonl", "csv")
+CSV_HEADER = ("section", "file", "parents", "key", "value")
+
+# Sections per task when exporting in parallel
+CHUNK_SIZE = 2000
+
+def select_names(ltx, sections=None):
+    """The names of the sections matching a glob (all of them for None), without decoding them"""
+    if sections is None:
+        return list(ltx.section)
+
+    return [name for name in ltx.section if fnmatchcase(name, sections)]
+
+def iter_records(ltx, names=None, keys=None):
+    """
+    Yield the export record of each named section (all of them for None), in order.
+    keys is a list of glob patterns limiting the exported keys.
+    """
+    if names is None:
+        names = ltx.section
+
+    for name in names:
+        sec = ltx.section[name]
+        # Descendants can only hold an index if this section does, so dropping
+        # one built here never discards anything cached before the export
+        cached = sec._resolved is not None
+        values = sec.resolved()
+
+        if keys is not None:
+            values = {k: v for k, v in values.items() if any(fnmatchcase(str(k), pattern) for pattern in keys)}
+        else:
+            values = dict(values)
+
+        yield {
+            "section": sec.name,
+            "file": str(sec.defined_in.path) if sec.defined_in is not None else None,
+            "parents": [parent.name for parent in sec.parents],
+            "chain": [ancestor.name for ancestor in sec.linearized()[1:]],
+            "keys": values,
+        }
+
+        if not cached:
+            sec.invalidate()
+
+def format_jsonl(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+def format_csv(records):
+    """Yields CSV text, one row per key of each record, without the header"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+
+    for record in records:
+        parents = ", ".join(record["parents"])
+
+        for key, value in record["keys"].items():
+            if isinstance(value, (list, tuple)):
+                value = ", ".join(value)
+
+            writer.writerow((record["section"], record["file"], parents, key, "" if value is None else value))
+
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+FORMATTERS = {"jsonl": format_jsonl, "csv": format_csv}
+
+def _export_chunk(snapshot_path, names, keys, fmt):
+    # Each chunk maps the snapshot afresh, so a worker only holds the sections of one chunk
+    ltx = open_snapshot(snapshot_path)
+    return "".join(FORMATTERS[fmt](iter_records(ltx, names, keys)))
+
+def export(ltx, fp, fmt="jsonl", sections=None, keys=None, workers=None, snapshot_path=None):
+    """
+    Write the resolved sections of ltx to the text file fp in fmt ("jsonl" or "csv").
+    sections is a glob selecting sections by name and keys a list of globs selecting keys.
+
+    With workers and the path of a snapshot of ltx (see StalkerGameData.fresh_snapshot_path),
+    chunks of sections are formatted in worker processes which each map the snapshot,
+    and written in order. workers=0 uses one per CPU.
+    Returns the number of sections written.
+    """
+    if fmt not in FORMATTERS:
+        raise ValueError("format must be one of %s" % (", ".join(FORMATS)))
+
+    names = select_names(ltx, sections)
+
+    if fmt == "csv":
+        fp.write(",".join(CSV_HEADER) + "\n")
+
+    if workers is None or workers == 1 or snapshot_path is None:
+        if workers is not None and workers != 1:
+            log.warning("Exporting serially, parallel export needs a snapshot")
+
+        for text in FORMATTERS[fmt](iter_records(ltx, names, keys)):
+            fp.write(text)
+
+        return len(names)
+
+    chunks = (names[i:i+CHUNK_SIZE] for i in range(0, len(names), CHUNK_SIZE))
+    workers = workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Only a few chunks are in flight at once, so finished text can't pile up
+        in_flight = deque()
+        window = 2 * workers
+
+        for chunk in islice(chunks, window):
+            in_flight.append(pool.submit(_export_chunk, snapshot_path, chunk, keys, fmt))
+
+        while in_flight:
+            fp.write(in_flight.popleft().result())
+
+            for chunk in islice(chunks, 1):
+                in_flight.append(pool.submit(_export_chunk, snapshot_path, chunk, keys, fmt))
+
+    return len(names)
@@ -1,10 +1,18 @@
 import logging
 import glob
+import hashlib
 import re
+import sys
+import time
 
-from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
 from enum import Enum
+from fnmatch import fnmatchcase
 from pathlib import Path, PureWindowsPath
+from types import MappingProxyType
+
+from .stats import LoadStats
 
 log = logging.getLogger(__name__)
 
@@ -25,24 +33,76 @@ class LTXFile:
         self.path = path
         self.tree = None
 
-    def read(self):
-        data = open(self.path, 'rb').read()
-
+    @staticmethod
+    def decode(data):
+        """Returns the text of raw LTX file contents and the encoding it was decoded with"""
         try:
             # utf-8-sig will correctly handle BOM/no-BOM encodings
-            return data.decode("utf-8-sig")
+            return data.decode("utf-8-sig"), "utf-8-sig"
         except UnicodeDecodeError:
-            return data.decode("latin1")
+            return data.decode("latin1"), "latin1"
+
+    def read(self):
+        return self.decode(open(self.path, 'rb').read())[0]
 
     def __repr__(self):
         return "<LTXFile %s>" % (self.path)
 
+# As in CInifile::r_bool, anything else is false
+_TRUE_VALUES = frozenset(("on", "yes", "true", "1"))
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+def _to_vector(value):
+    if isinstance(value, str):
+        value = value.split(",")
+
+    return tuple(float(v) for v in value)
+
+_CONVERTERS = {
+    "float": float,
+    "int": _to_int,
+    "bool": lambda value: value.lower() in _TRUE_VALUES,
+    "vector": _to_vector,
+}
+
 class LTXSection:
+    """
+    A section and its parents, resolving inherited keys as the engine does.
+
+    The keys a section sees from its whole ancestry are flattened into a resolved
+    index the first time they are needed. A set() on the section or any of its
+    ancestors invalidates the index for it and all of its descendants.
+
+    get() and get_all() return copies which are safe to modify. get_view(), get_tuple()
+    and get_all_view() return read-only views of the index, with lists as tuples, at no copy cost.
+
+    get_float(), get_int(), get_bool() and get_vector() convert values as the engine reads
+    them. Converted values are cached with the resolved index and invalidated along with it.
+
+    fingerprint() hashes the section's own keys together with the fingerprints of its
+    parents, so sections with equal fingerprints resolve to the same keys.
+    """
+    __slots__ = ("name", "parents", "keys", "defined_in", "children", "_resolved", "_key_hier", "_typed",
+            "_fingerprint")
+
     def __init__(self, name, parents=[]):
         self.name = name
         self.parents = parents
         self.keys = {}
         self.defined_in = None
+        self.children = []
+        self._resolved = None
+        self._key_hier = None
+        self._typed = None
+        self._fingerprint = None
+
+        for parent in parents:
+            parent.children.append(self)
 
     def set_declaration_info(self, ltx_file):
         self.defined_in = ltx_file
@@ -52,61 +112,161 @@ class LTXSection:
 
     def set(self, key, value=None):
         self.keys[key] = value
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop the resolved index of this section and every section inheriting from it"""
+        pending = [self]
+        seen = set()
+
+        while pending:
+            sec = pending.pop()
+
+            # Descendants can only hold an index if their ancestors do
+            if id(sec) in seen or (sec._resolved is None and sec._key_hier is None
+                    and sec._typed is None and sec._fingerprint is None):
+                continue
+
+            seen.add(id(sec))
+            sec._resolved = None
+            sec._key_hier = None
+            sec._typed = None
+            sec._fingerprint = None
+            pending.extend(sec.children)
+
+    def resolved(self):
+        """
+        Returns the flattened key map of this section, in get_all() order.
+        Later parents override earlier ones and the section's own keys override all parents.
+        List values are frozen as tuples. The returned dict is shared and must not be modified.
+        """
+        if self._resolved is None:
+            values = {}
+
+            for parent in self.parents:
+                values.update(parent.resolved())
+
+            for k, v in self.keys.items():
+                values[k] = tuple(v) if isinstance(v, list) else v
+
+            self._resolved = values
+
+        return self._resolved
+
+    def fingerprint(self):
+        """
+        Returns a 16 byte digest of the keys this section resolves to: its own keys, in order,
+        and the fingerprints of its parents. The name is not part of it.
+        """
+        if self._fingerprint is None:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(b"%d:" % (len(self.parents)))
+
+            for parent in self.parents:
+                h.update(parent.fingerprint())
+
+            h.update(repr([(k, tuple(v) if isinstance(v, list) else v) for k, v in self.keys.items()]).encode("utf-8"))
+            self._fingerprint = h.digest()
+
+        return self._fingerprint
+
+    def linearized(self):
+        """Returns this section and its ancestors in lookup order (later parents first), without repeats"""
+        order = []
+        seen = set()
+        pending = [self]
+
+        while pending:
+            sec = pending.pop()
+
+            if id(sec) in seen:
+                continue
+
+            seen.add(id(sec))
+            order.append(sec)
+            pending.extend(sec.parents)
+
+        return order
 
     def get_key_hier(self, key):
-        values = []
-        value = self.get(key)
+        if self._key_hier is None:
+            self._key_hier = {}
 
-        # No parents have the value if we dont
-        if value is None:
-            return []
+        hier = self._key_hier.get(key)
 
-        values.append((value, self))
+        if hier is None:
+            hier = []
+            value = self._lookup(key)
 
-        for sec in self.parents[::-1]:
-            value = sec.get_key_hier(key)
+            # No parents have the value if we dont
+            if value is not None:
+                hier.append((value, self))
+                seen = {id(self)}
+
+                for sec in self.parents[::-1]:
+                    for entry in sec.get_key_hier(key):
+                        if id(entry[1]) not in seen:
+                            seen.add(id(entry[1]))
+                            hier.append(entry)
 
-            if len(value):
-                values += value
+            self._key_hier[key] = hier
 
-        return values
+        return [(list(value) if isinstance(value, (list, tuple)) else value, sec) for value, sec in hier]
 
     def has(self, key):
-        return self.get(key) is not None
+        return self._lookup(key) is not None
 
     def get_all(self):
-        values = {}
-
-        for parent in self.parents:
-            pvalues = parent.get_all()
-            # later parents override values
-            values.update(pvalues)
+        return {k: list(v) if isinstance(v, tuple) else v for k, v in self.resolved().items()}
 
-        # current section overrides parents
-        values.update(self.keys)
+    def get_all_view(self):
+        return MappingProxyType(self.resolved())
 
-        return deepcopy(values)
+    def _lookup(self, key, default=None):
+        resolved = self.resolved()
 
-    def get(self, key, default=None):
         if key in self.keys:
-            value = self.keys.get(key, default)
-            if isinstance(value, list):
-                value = list(value)
+            return resolved[key]
+
+        if key not in resolved:
+            return default
+
+        value = resolved[key]
+
+        if value is not None:
             return value
 
-        # Later parents take precedence
+        # A later parent explicitly assigned nothing, so fall back to the first
+        # parent (latest first) which has a value
         for parent in self.parents[::-1]:
-            value = parent.get(key, None)
+            value = parent._lookup(key)
 
             if value is not None:
-                if isinstance(value, list):
-                    # make a copy of the list as we don't want direct object modification
-                    value = list(value)
-
                 return value
 
         return default
 
+    def get(self, key, default=None):
+        value = self._lookup(key, default)
+
+        if isinstance(value, (list, tuple)):
+            # make a copy of the list as we don't want direct object modification
+            value = list(value)
+
+        return value
+
+    def get_view(self, key, default=None):
+        return self._lookup(key, default)
+
+    def get_tuple(self, key):
+        val = self._lookup(key, ())
+        if isinstance(val, str):
+            val = (val,)
+        elif val is None:
+            val = ()
+
+        return val
+
     def get_list(self, key):
         val = self.get(key, [])
         if isinstance(val, str):
@@ -120,24 +280,319 @@ class LTXSection:
         for i in self.get_list(key):
             yield i
 
+    def get_typed(self, key, kind, default=None):
+        """
+        Returns the value of key converted to kind ("float", "int", "bool" or "vector"), or
+        default when the key is missing. Raises ValueError when the value can not be converted.
+        """
+        if self._typed is None:
+            self._typed = {}
+
+        cache_key = (kind, key)
+        value = self._typed.get(cache_key)
+
+        if value is not None:
+            return value
+
+        raw = self._lookup(key)
+
+        if raw is None:
+            return default
+
+        if kind != "vector" and isinstance(raw, tuple):
+            raise ValueError("%s.%s is a list, not a single %s: %r" % (self.name, key, kind, raw))
+
+        try:
+            value = _CONVERTERS[kind](raw)
+        except ValueError:
+            raise ValueError("%s.%s is not a %s: %r" % (self.name, key, kind, raw)) from None
+
+        self._typed[cache_key] = value
+        return value
+
+    def get_float(self, key, default=None):
+        return self.get_typed(key, "float", default)
+
+    def get_int(self, key, default=None):
+        return self.get_typed(key, "int", default)
+
+    def get_bool(self, key, default=None):
+        return self.get_typed(key, "bool", default)
+
+    def get_vector(self, key, default=None):
+        """Returns a comma separated value as a tuple of floats"""
+        return self.get_typed(key, "vector", default)
+
     def __repr__(self):
         return "<LTXSection %s, parents=%s, keys=%d, file=%s>" % \
                 (self.name, len(self.parents), len(self), self.defined_in.path.name)
 
+class LTXParseCache:
+    """
+    Memoizes include parse trees for the duration of a single load, so that a file
+    included from many places is only lexed and parsed once.
+    Entries are keyed on the resolved path along with its mtime and size. With fs, a
+    LayeredFS, files in its index are keyed on their real path alone, without touching
+    the disk, since the index is fixed for the duration of the load.
+    """
+    def __init__(self, fs=None):
+        self.fs = fs
+        self.trees = {}
+        self.files = 0
+        self.hits = 0
+
+    def key(self, path):
+        if self.fs is not None and self.fs.virtual_path(path) is not None:
+            return Path(path)
+
+        path = Path(path).resolve()
+        st = path.stat()
+        return (path, st.st_mtime_ns, st.st_size)
+
+    def get(self, key):
+        tree = self.trees.get(key)
+
+        if tree is not None:
+            self.hits += 1
+
+        return tree
+
+    def put(self, key, tree):
+        self.trees[key] = tree
+        self.files += 1
+
+    def clear(self):
+        # Only the counters are kept once the load is done
+        self.trees = {}
+
+    def __len__(self):
+        return self.files
+
+    def __repr__(self):
+        return "<LTXParseCache files=%d, reparses_saved=%d>" % (len(self), self.hits)
+
 class LTXFileRoot:
-    def __init__(self, ltx_root_path):
+    """
+    The sections of an LTX file and everything it includes, in load order.
+
+    In compact mode names, keys and values are interned, list values are stored as
+    tuples and identical values are shared between sections, which greatly reduces
+    the memory held by large configs.
+    """
+    def __init__(self, ltx_root_path, compact=False, fs=None):
         self.ltx_root = LTXFile(ltx_root_path)
         self.section = {}
+        self.parse_cache = None
+        self.compact = compact
+        # Includes are resolved through this LayeredFS when set
+        self.fs = fs
+        self._values = None
 
     def get(self, name):
         return self.section[name]
 
-    def parse(self):
+    def select(self, names=None):
+        """
+        Returns a list of sections: every section for None, those whose name matches
+        a glob pattern for a string, or the named sections of an iterable in its order.
+        """
+        if names is None:
+            return list(self.section.values())
+        elif isinstance(names, str):
+            return [self.section[name] for name in self.section if fnmatchcase(name, names)]
+
+        return [self.section[name] for name in names]
+
+    def records(self):
+        """
+        Returns every section reachable from the section table, each after its parents.
+        This includes overwritten sections which are still parents of other sections.
+        """
+        order = []
+        seen = set()
+
+        for sec in self.section.values():
+            pending = [(sec, False)]
+
+            while pending:
+                sec, expanded = pending.pop()
+
+                if expanded:
+                    order.append(sec)
+                    continue
+
+                if id(sec) in seen:
+                    continue
+
+                seen.add(id(sec))
+                pending.append((sec, True))
+
+                for parent in reversed(sec.parents):
+                    if id(parent) not in seen:
+                        pending.append((parent, False))
+
+        return order
+
+    # Kinds which convert to a single float. Vectors vary in length, so they have no column
+    COLUMN_KINDS = ("float", "int", "bool")
+
+    @classmethod
+    def _check_column_kind(cls, kind):
+        if kind not in cls.COLUMN_KINDS:
+            raise ValueError("column kind must be one of %s, not %r (use LTXSection.get_vector for vectors)"
+                    % (", ".join(cls.COLUMN_KINDS), kind))
+
+    @staticmethod
+    def _column_value(sec, key, kind):
+        try:
+            value = sec.get_typed(key, kind)
+        except ValueError:
+            return float("nan")
+
+        return float("nan") if value is None else float(value)
+
+    def column(self, key, names=None, kind="float"):
+        """
+        Returns a NumPy float array of key across the sections chosen by names (see select),
+        converted as LTXSection.get_typed does. Missing and unconvertible values are NaN.
+        kind is one of COLUMN_KINDS.
+        """
+        import numpy as np
+
+        self._check_column_kind(kind)
+        sections = self.select(names)
+        return np.fromiter((self._column_value(sec, key, kind) for sec in sections),
+                dtype=np.float64, count=len(sections))
+
+    def columns(self, keys, names=None, kind="float"):
+        """
+        Returns a NumPy structured array with one row per section chosen by names (see select),
+        a "name" field and one float field per key, filled as column() does.
+        """
+        import numpy as np
+
+        self._check_column_kind(kind)
+        sections = self.select(names)
+        name_len = max((len(sec.name) for sec in sections), default=1)
+        dtype = [("name", "U%d" % (name_len))] + [(key, np.float64) for key in keys]
+
+        table = np.empty(len(sections), dtype=dtype)
+        table["name"] = [sec.name for sec in sections]
+
+        for key in keys:
+            table[key] = [self._column_value(sec, key, kind) for sec in sections]
+
+        return table
+
+    def parse(self, tree_cache=None, workers=None, stats=None):
+        """Parse and build every section. With a LoadStats, the parse and build phases are recorded in it"""
+        if stats is None:
+            self._parse(tree_cache, workers, None)
+            return
+
+        with stats.phase("ltx.load"):
+            self._parse(tree_cache, workers, stats)
+
+        stats.count("ltx.files", len(self.parse_cache))
+        stats.count("ltx.parse_cache.hits", self.parse_cache.hits)
+        stats.count("ltx.sections", len(self.section))
+
+    def _parse(self, tree_cache, workers, stats):
         # Build the LTX parse tree
-        tree = parse_ltx(self.ltx_root.path)
+        self.parse_cache = LTXParseCache(fs=self.fs)
+
+        with stats.phase("ltx.parse") if stats else nullcontext():
+            if workers is not None and workers != 1:
+                tree = parse_ltx_parallel(self.ltx_root.path, workers=workers,
+                        cache=self.parse_cache, tree_cache=tree_cache, stats=stats, fs=self.fs)
+            else:
+                tree = parse_ltx(self.ltx_root.path, cache=self.parse_cache, tree_cache=tree_cache, stats=stats, fs=self.fs)
+
+        log.info("Parsed %d LTX files, %d re-parses saved", len(self.parse_cache), self.parse_cache.hits)
 
         # Walk the tree, building sections in-order
-        self._build(self.ltx_root, tree)
+        with stats.phase("ltx.build") if stats else nullcontext():
+            self._values = {} if self.compact else None
+            self._build(self.ltx_root, tree)
+            self._values = None
+
+        self.parse_cache.clear()
+
+    def _compact_value(self, value):
+        if isinstance(value, str):
+            return sys.intern(value)
+        elif isinstance(value, list):
+            value = tuple(map(sys.intern, value))
+            return self._values.setdefault(value, value)
+
+        return value
+
+    def memory_footprint(self):
+        """
+        Estimates the bytes held by the section table, counting objects shared
+        between sections (such as interned strings) only once.
+        """
+        seen = set()
+
+        def size(obj):
+            if id(obj) in seen:
+                return 0
+
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        total = size(self.section)
+
+        for name, sec in self.section.items():
+            total += size(name) + size(sec) + size(sec.keys) + size(sec.parents) + size(sec.children)
+
+            for k, v in sec.keys.items():
+                total += size(k) + size(v)
+
+                if isinstance(v, (list, tuple)):
+                    total += sum(map(size, v))
+
+            if sec._resolved is not None:
+                total += size(sec._resolved)
+
+            if sec._typed is not None:
+                total += size(sec._typed)
+
+        return total
+
+    def _assign(self, sec, key, assign_values):
+        # Keyless lines are numbered, and single values are stored unwrapped
+        if key is None:
+            key = len(sec)
+
+        if len(assign_values) == 1:
+            assign_values = assign_values[0]
+        elif len(assign_values) == 0:
+            assign_values = None
+
+        if self.compact:
+            if isinstance(key, str):
+                key = sys.intern(key)
+
+            assign_values = self._compact_value(assign_values)
+
+        sec.set(key, assign_values)
+
+    def _unlink_overwritten(self, sec):
+        # An overwritten section stays linked while sections declared before the
+        # overwrite still inherit from it. Once none do, its parents forget it, and
+        # so on up any chain of overwritten ancestors it was keeping linked.
+        pending = [sec]
+
+        while pending:
+            sec = pending.pop()
+
+            if sec.children or self.section.get(sec.name) is sec:
+                continue
+
+            for parent in sec.parents:
+                parent.children.remove(sec)
+                pending.append(parent)
 
     def _build(self, ltx_file, tree):
         cur_section = None
@@ -151,7 +606,12 @@ class LTXFileRoot:
                 self._build(inc_ltx, inc_ltx_tree)
             elif ty == "SECTION":
                 name, parents = values
-                if name in self.section:
+                if self.compact:
+                    name = sys.intern(name)
+
+                old_section = self.section.get(name)
+
+                if old_section is not None:
                     log.warning("Overwriting section %s", name)
 
                 sec_parents = []
@@ -165,24 +625,18 @@ class LTXFileRoot:
                 cur_section.set_declaration_info(ltx_file)
 
                 self.section[name] = cur_section
-            elif ty == "ASSIGN":
-                key, assign_values = values
-
-                if key is None:
-                    key = len(cur_section)
 
-                if len(assign_values) == 1:
-                    assign_values = assign_values[0]
-                elif len(assign_values) == 0:
-                    assign_values = None
-
-                cur_section.set(key, assign_values)
+                if old_section is not None:
+                    self._unlink_overwritten(old_section)
+            elif ty == "ASSIGN":
+                self._assign(cur_section, *values)
             else:
                 assert 0, "Unhandled type %s" % (ty)
 
 class LTXToken(Enum):
     INHERIT = re.compile(r'[:]')
-    INCLUDE = re.compile(r'#include')
+    # A longer identifier such as "#includes" must not be split into a directive
+    INCLUDE = re.compile(r'#include(?![^\[\]"=\n\r\t ,;{}])')
     COMMA = re.compile(r'[,]')
     ASSIGN = re.compile(r'[=]')
     HEADER_OPEN = re.compile(r'[\[]')
@@ -192,165 +646,365 @@ class LTXToken(Enum):
     QUOTED_STRING = re.compile(r'"[^\n\r"]*"')
     CONSTRAINT = re.compile(r'\{[^\n\r}]*\}')
     EVAL = re.compile(r'%[^\n\r%]*%')
-    EOL = re.compile(r'(\r\n|\n)')
-
-    @classmethod
-    def get_match(cls, stream):
-        choice = None
-
-        for k, v in cls.__members__.items():
-            m = v.value.match(stream)
-            if m:
-                string = m.group(0)
-                if choice:
-                    if len(string) > len(choice[1]):
-                        choice = (k, string)
-                else:
-                    choice = (k, string)
+    EOL = re.compile(r'(?:\r\n|\n)')
 
-        return choice
+class LTXLexer:
+    """
+    Single pass LTX tokenizer.
 
-class LTXParseContext:
-    WHITESPACE = re.compile(r'[\n\r\t ]+')
-    SPACING = re.compile(r'[\t ]+')
-    COMMENT = re.compile(r'(;|--|//)[^\r\n]*')
+    Every token pattern is combined into one master regex which is matched in-place at
+    the current offset, so the input is never sliced. Whitespace and comments are skipped
+    before each token. The line and column of the last token are tracked for error reporting.
+    """
+    SKIP = re.compile(r'(?:[\t ]+|(?:;|--|//)[^\r\n]*)+')
+    MASTER = re.compile("|".join("(?P<%s>%s)" % (name, tok.value.pattern)
+        for name, tok in LTXToken.__members__.items()))
 
-    def __init__(self, data):
+    def __init__(self, data, path=None):
         self.data = data
+        self.path = path
         self.offset = 0
         self.line = 0
-        self.column = 0
+        self.line_start = 0
+        self.token_offset = 0
+        self.tokens = 0
+        self._peeked = None
 
-    def get_data(self):
-        return self.data[self.offset:]
+    @property
+    def column(self):
+        return self.token_offset - self.line_start
 
-    def advance(self, amt):
-        skip_data = self.data[self.offset:self.offset+amt]
-        newlines = skip_data.count("\n")
+    def _scan(self):
+        data = self.data
+        offset = self.offset
 
-        if newlines > 0:
-            self.line += newlines
-            self.column = len(skip_data) - (skip_data.rfind("\n") + 1) - 1
-        else:
-            self.column += amt
-
-        self.offset += amt
+        m = self.SKIP.match(data, offset)
+        if m:
+            offset = m.end()
 
-    def get_match(self):
-        data = self.get_data()
+        self.token_offset = offset
+        self.tokens += 1
 
-        if len(data) == 0:
+        if offset >= len(data):
+            self.offset = offset
             return ("EOF", "")
 
-        m = LTXToken.get_match(data)
+        m = self.MASTER.match(data, offset)
         if m is None:
-            self.error("Unable to match token '%s'", data[:1])
+            self.offset = offset
+            self.error("Unable to match token '%s'", data[offset])
 
-        return m
+        tok = m.lastgroup
+        end = m.end()
 
-    def skip_ws(self):
-        while True:
-            data = self.get_data()
+        # An identifier may begin with '%', in which case the longest of the two wins
+        if tok == "IDENTIFIER" and data[offset] == "%":
+            m = LTXToken.EVAL.value.match(data, offset)
+            if m and m.end() > end:
+                tok = "EVAL"
+                end = m.end()
 
-            m = LTXParseContext.SPACING.match(data)
-            if m:
-                self.advance(len(m.group(0)))
-                continue
+        self.offset = end
 
-            m = LTXParseContext.COMMENT.match(data)
-            if m:
-                self.advance(len(m.group(0)))
-                continue
+        if tok == "EOL":
+            self.line += 1
+            self.line_start = end
 
-            break
+        return (tok, data[offset:end])
+
+    def peek(self):
+        if self._peeked is None:
+            self._peeked = self._scan()
+
+        return self._peeked
+
+    def next(self):
+        tok = self.peek()
+        self._peeked = None
+        return tok
+
+    def __iter__(self):
+        while True:
+            tok = self.next()
+            yield tok
+
+            if tok[0] == "EOF":
+                break
 
     def error(self, message, *args):
-        raise LTXParseError(message % tuple(args))
+        message = message % tuple(args)
+        raise LTXParseError("%s:%d:%d: %s" % (self.path, self.line + 1, self.column + 1, message))
+
+def resolve_includes(ltx_path, bare_path, fs=None):
+    """
+    Yields the files an include directive of ltx_path refers to. With a LayeredFS,
+    the include is resolved against its index relative to the virtual path of ltx_path,
+    so it may match files from any layer.
+    """
+    virtual = fs.virtual_path(ltx_path) if fs is not None else None
+
+    if virtual is not None:
+        include_path = PureWindowsPath(virtual).parent / PureWindowsPath(bare_path)
+
+        if bare_path.find("*") != -1:
+            yield from fs.glob(include_path)
+        else:
+            include = fs.resolve(include_path)
+
+            if include is not None:
+                yield include
+            else:
+                log.warning("Missing include %s", include_path)
 
-def parse_ltx(top_level_ltx):
-    log.info("Parsing %s", top_level_ltx)
-    ltx_top = LTXFile(Path(top_level_ltx))
-    ltx_data = ltx_top.read()
+        return
 
-    ctx = LTXParseContext(ltx_data)
+    # Normalize windows paths
+    include_value = PureWindowsPath(bare_path)
+    include_path = Path(ltx_path).parent / include_value
 
-    section_name = None
+    if bare_path.find("*") != -1:
+        includes = sorted(map(lambda x: Path(x), glob.glob(str(include_path))))
+    else:
+        includes = [include_path]
+
+    for include in includes:
+        if include.exists():
+            yield include
+        else:
+            log.warning("Missing include %s", include)
+
+def include_watch_dirs(ltx_path, bare_path, fs=None):
+    """
+    The directories whose mtimes change when files matching an include directive are added
+    or removed, in every layer of fs when given
+    """
+    virtual = fs.virtual_path(ltx_path) if fs is not None else None
+
+    if virtual is not None:
+        return fs.watch_dirs((PureWindowsPath(virtual).parent / PureWindowsPath(bare_path)).parent)
+
+    include_dir = (Path(ltx_path).parent / PureWindowsPath(bare_path)).parent
+    return [include_dir] if include_dir.is_dir() else []
+
+def parse_ltx(top_level_ltx, cache=None, tree_cache=None, stats=None, fs=None):
+    """
+    Parse an LTX file and, recursively, everything it includes.
+
+    Returns a tree where each include directive is expanded in-place to
+    ("INCLUDE", LTXFile, tree). The per-file trees may come from a persistent
+    tree_cache (see pystalker.gamedata.cache.FileCache) and are memoized in cache.
+    Per-file timings and include fan-out are recorded in stats, a LoadStats.
+    Includes are resolved through fs, a LayeredFS, when given.
+    """
+    if cache is not None:
+        cache_key = cache.key(top_level_ltx)
+        tree = cache.get(cache_key)
+
+        if tree is not None:
+            return tree
+
+    top_level_ltx = Path(top_level_ltx)
+
+    if tree_cache is not None:
+        file_tree = tree_cache.lookup(top_level_ltx)
+
+        if file_tree is None:
+            file_tree = parse_ltx_file(top_level_ltx, stats=stats)
+            tree_cache.put(top_level_ltx, file_tree)
+    else:
+        file_tree = parse_ltx_file(top_level_ltx, stats=stats)
 
     tree = []
+    includes = 0
+
+    for entry in file_tree:
+        if entry[0] == "INCLUDE_PATH":
+            for include in resolve_includes(top_level_ltx, entry[1], fs=fs):
+                inc_ltx = LTXFile(include)
+                inc_ltx_tree = parse_ltx(include, cache=cache, tree_cache=tree_cache, stats=stats, fs=fs)
+                tree.append(("INCLUDE", inc_ltx, inc_ltx_tree))
+                includes += 1
+        else:
+            tree.append(entry)
 
-    while ctx.offset < len(ltx_data):
-        ctx.skip_ws()
-        tok, v = ctx.get_match()
+    if stats is not None:
+        stats.file(top_level_ltx, "ltx").includes = includes
 
-        if 0:
-            data = ctx.get_data()
-            line = data[:data.find("\n")]
+    if cache is not None:
+        cache.put(cache_key, tree)
 
-            print("LINE '%s'" % (line.replace("\t", " ").strip()))
+    return tree
 
-        if tok == "EOL":
-            ctx.advance(len(v))
-            ctx.skip_ws()
-            continue
-        elif tok == "INCLUDE":
-            ctx.advance(len(v))
-            ctx.skip_ws()
+def _parse_ltx_file_stats(ltx_path):
+    # Worker processes collect the stats of their file and return them with the tree
+    stats = LoadStats()
+    return parse_ltx_file(ltx_path, stats=stats), stats.file(ltx_path, "ltx")
 
-            tok, v = ctx.get_match()
+def parse_ltx_parallel(top_level_ltx, workers=0, cache=None, tree_cache=None, stats=None, fs=None):
+    """
+    Equivalent to parse_ltx, but the include graph is discovered breadth-first while
+    every file is lexed and parsed in a pool of worker processes (workers=0 uses one per CPU).
+    The nested tree is then assembled in include order, so the result is identical to a serial parse.
+    """
+    top_level_ltx = Path(top_level_ltx)
 
-            if tok != "QUOTED_STRING":
-                ctx.error("Expected string as include argument")
+    file_trees = {}
+    includes = {}
+    futures = {}
+    queue = [top_level_ltx]
 
-            ctx.advance(len(v))
+    def discover(path, file_tree):
+        file_trees[str(path)] = file_tree
+        fan_out = 0
 
-            # Normalize windows paths
-            bare_path = v[1:-1]
-            include_value = PureWindowsPath(bare_path)
-            include_path = ltx_top.path.parent / include_value
+        for entry in file_tree:
+            if entry[0] == "INCLUDE_PATH":
+                include_key = (str(path), entry[1])
 
-            if bare_path.find("*") != -1:
-                includes = sorted(map(lambda x: Path(x), glob.glob(str(include_path))))
-            else:
-                includes = [include_path]
+                if include_key not in includes:
+                    includes[include_key] = list(resolve_includes(path, entry[1], fs=fs))
+                    queue.extend(includes[include_key])
+
+                fan_out += len(includes[include_key])
+
+        if stats is not None:
+            stats.file(path, "ltx").includes = fan_out
+
+    with ProcessPoolExecutor(max_workers=workers or None) as pool:
+        in_flight = set()
+
+        while queue or futures:
+            while queue:
+                path = queue.pop(0)
+                key = str(path)
 
-            for include in includes:
-                if include.exists():
-                    inc_ltx = LTXFile(include)
-                    inc_ltx_tree = parse_ltx(include)
-                    tree.append(("INCLUDE", inc_ltx, inc_ltx_tree))
+                if key in file_trees or key in in_flight:
+                    continue
+
+                file_tree = tree_cache.lookup(path) if tree_cache is not None else None
+
+                if file_tree is None:
+                    futures[pool.submit(parse_ltx_file if stats is None else _parse_ltx_file_stats, path)] = path
+                    in_flight.add(key)
                 else:
-                    log.warning("Missing include %s", include)
+                    discover(path, file_tree)
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                path = futures.pop(future)
+                file_tree = future.result()
+
+                if stats is not None:
+                    file_tree, file_stats = file_tree
+                    stats.add_file(file_stats)
+
+                if tree_cache is not None:
+                    tree_cache.put(path, file_tree)
+
+                in_flight.discard(str(path))
+                discover(path, file_tree)
+
+    def assemble(path):
+        if cache is not None:
+            cache_key = cache.key(path)
+            tree = cache.get(cache_key)
+
+            if tree is not None:
+                return tree
+
+        tree = []
+
+        for entry in file_trees[str(path)]:
+            if entry[0] == "INCLUDE_PATH":
+                for include in includes[(str(path), entry[1])]:
+                    tree.append(("INCLUDE", LTXFile(include), assemble(include)))
+            else:
+                tree.append(entry)
 
+        if cache is not None:
+            cache.put(cache_key, tree)
+
+        return tree
+
+    return assemble(top_level_ltx)
+
+def parse_ltx_file(ltx_path, stats=None):
+    """
+    Parse a single LTX file without following its includes.
+
+    Include directives are left in the tree as ("INCLUDE_PATH", path) entries,
+    with the path exactly as written in the file.
+    """
+    log.info("Parsing %s", ltx_path)
+    ltx_top = LTXFile(Path(ltx_path))
+
+    if stats is None:
+        return parse_ltx_data(ltx_top.read(), ltx_top.path)
+
+    file_stats = stats.file(ltx_top.path, "ltx")
+
+    start = time.perf_counter()
+    data = open(ltx_top.path, 'rb').read()
+    ltx_data = LTXFile.decode(data)[0]
+    read = time.perf_counter()
+
+    tree = parse_ltx_data(ltx_data, ltx_top.path, file_stats=file_stats)
+
+    file_stats.size = len(data)
+    file_stats.read += read - start
+    file_stats.parse += time.perf_counter() - read
+    return tree
+
+def parse_ltx_data(ltx_data, path=None, first_line=0, locations=None, file_stats=None):
+    """
+    Parse LTX text into a tree as parse_ltx_file does. first_line numbers the lines
+    of text taken from within a file. With a locations list, the (offset, line) of each
+    section header in ltx_data is appended to it. Tokens are counted in file_stats.
+    """
+    lex = LTXLexer(ltx_data, path)
+    lex.line = first_line
+
+    section_name = None
+
+    tree = []
+
+    while True:
+        tok, v = lex.next()
+
+        if tok == "EOL":
+            continue
+        elif tok == "INCLUDE":
+            tok, v = lex.next()
+
+            if tok != "QUOTED_STRING":
+                lex.error("Expected string as include argument")
+
+            tree.append(("INCLUDE_PATH", v[1:-1]))
         elif tok == "HEADER_OPEN":
-            ctx.advance(len(v))
-            ctx.skip_ws()
+            if locations is not None:
+                locations.append((lex.token_offset, lex.line))
 
-            tok, v = ctx.get_match()
+            tok, v = lex.next()
             if tok != "IDENTIFIER":
-                ctx.error("Expected section identifier after section start [")
+                lex.error("Expected section identifier after section start [")
 
             section_name = v
             section_parents = []
 
-            ctx.advance(len(v))
-            ctx.skip_ws()
-            tok, v = ctx.get_match()
+            tok, v = lex.next()
 
             if tok != "HEADER_CLOSE":
-                ctx.error("Expected section close ] after identifier")
+                lex.error("Expected section close ] after identifier")
 
-            ctx.advance(len(v))
-            ctx.skip_ws()
-            tok, v = ctx.get_match()
-
-            if tok == "INHERIT":
-                ctx.advance(len(v))
-                ctx.skip_ws()
+            if lex.peek()[0] == "INHERIT":
+                lex.next()
 
                 while True:
-                    tok, v = ctx.get_match()
-                    ctx.advance(len(v))
-                    ctx.skip_ws()
+                    tok, v = lex.next()
 
                     if tok == "COMMA":
                         pass
@@ -362,23 +1016,18 @@ def parse_ltx(top_level_ltx):
             tree.append(("SECTION", section_name, section_parents))
         elif tok == "IDENTIFIER":
             if section_name is None:
-                ctx.error("Identifier out of section")
+                lex.error("Identifier out of section")
 
             key = v
             assign_values = []
 
-            ctx.advance(len(v))
-            ctx.skip_ws()
-            tok, v = ctx.get_match()
+            tok, v = lex.peek()
 
             if tok == "ASSIGN":
-                ctx.advance(len(v))
-                ctx.skip_ws()
-
+                lex.next()
             elif tok == "EOL":
                 # bare identifier (section is a array of items, not a dict)
-                ctx.advance(len(v))
-                ctx.skip_ws()
+                lex.next()
 
                 # key was in-fact a value assignment to an array index (determined later)
                 assign_values.append(key)
@@ -388,9 +1037,7 @@ def parse_ltx(top_level_ltx):
             is_csv = False
 
             while True:
-                tok, v = ctx.get_match()
-                ctx.advance(len(v))
-                ctx.skip_ws()
+                tok, v = lex.next()
 
                 # null assignment
                 if tok == "EOL" or tok == "EOF":
@@ -417,6 +1064,9 @@ def parse_ltx(top_level_ltx):
         elif tok == "EOF":
             break
         else:
-            ctx.error("Unhandled token %s", tok)
+            lex.error("Unhandled token %s", tok)
+
+    if file_stats is not None:
+        file_stats.tokens += lex.tokens
 
     return tree
@@ -1,28 +1,111 @@
-import hashlib
-import pickle
+import logging
+import pystalker.gamedata.color_map
 import pystalker.gamedata.ltx
 import pystalker.gamedata.string_table
+import pystalker.gamedata.texture_description
 
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path, PureWindowsPath
+from .cache import FileCache
+from .snapshot import LTXSnapshot, LTXSnapshotError, collect_depends, is_snapshot_fresh, write_snapshot
+from .xref import XrefIndex
+from .query import LTXQueryEngine
+from .vfs import LayeredFS
+from .section_index import LTXSectionIndex
+
+log = logging.getLogger(__name__)
 
 class StalkerGameData:
+    """
+    The game data under gamebase, a directory or a LayeredFS of mod folders over the base game.
+    With a LayeredFS, every file and include is resolved through its index.
+    """
     def __init__(self, gamebase):
-        self.gamebase = Path(gamebase)
+        if isinstance(gamebase, LayeredFS):
+            self.fs = gamebase if len(gamebase) else gamebase.build()
+            self.gamebase = gamebase.roots[0]
+        else:
+            self.fs = None
+            self.gamebase = Path(gamebase)
+
         self._string_table = {}
+        self._texture_descriptions = None
         self._ini_sys = None
+        self._xref = None
+        self._query = None
         self._ini_cache_dir = None
+        self._workers = None
+        self._processes = True
+        self._compact = False
+        self._lazy = False
+        self._stats = None
+        # Snapshots loaded or written by this instance, which match the loaded sections
+        self._fresh_snapshots = set()
 
     def set_cache_dir(self, cache_dir):
+        """
+        Cache loaded data in cache_dir. A fresh snapshot loads LTX sections without
+        unpickling anything, but the parse trees a stale one is rebuilt from, like the
+        other caches, are pickles, so the directory must be trusted.
+        """
         self._ini_cache_dir = Path(cache_dir)
 
+    def set_compact(self, compact=True):
+        """Build LTX sections in compact mode (see LTXFileRoot)"""
+        self._compact = compact
+
+    def set_lazy(self, lazy=True):
+        """
+        When loading from a fresh snapshot in the cache directory, memory-map it and
+        only decode sections as they are accessed
+        """
+        self._lazy = lazy
+
+    def set_stats(self, stats):
+        """Record load timings and cache counters in stats, a LoadStats, or stop with None"""
+        self._stats = stats
+
+    def _phase(self, name):
+        return self._stats.phase(name) if self._stats is not None else nullcontext()
+
+    def _count_cache(self, name, cache):
+        if self._stats is not None and cache is not None:
+            self._stats.count(name + ".hits", cache.hits)
+            self._stats.count(name + ".misses", cache.misses)
+
+    def set_parallel(self, workers=0, processes=True):
+        """
+        Parse LTX include files across a pool of worker processes, and XML files across
+        a pool of worker processes (or threads, without processes).
+        workers=0 uses one per CPU and None restores serial loading.
+        """
+        self._workers = workers
+        self._processes = processes
+
+    def _real_path(self, path):
+        """The real path of a path relative to the game data, from the topmost layer which has it"""
+        if self.fs is not None:
+            real = self.fs.resolve(path)
+
+            if real is not None:
+                return real
+
+        return self.gamebase / path
+
+    def _cache_name(self, path):
+        # Caches of different layerings of the same files must not collide
+        name = Path(path).name.replace(".", "_")
+        return name + "_" + self.fs.layers_id() if self.fs is not None else name
+
     def open_texture(self, path):
         from PIL import Image
         path = Path(path)
 
-        if path.suffix:
-            return Image.open(self.gamebase / "textures" / path)
-        else:
-            return Image.open((self.gamebase / "textures" / path).with_suffix(".dds"))
+        if not path.suffix:
+            path = path.with_suffix(".dds")
+
+        return Image.open(self._real_path(Path("textures") / path))
 
     def ini_sys(self):
         if self._ini_sys:
@@ -32,44 +115,245 @@ class StalkerGameData:
         self._ini_sys = ltx
         return ltx
 
-    def load_ini(self, path):
-        path = self.gamebase / "configs" / path
+    def xref_index(self):
+        """
+        The cross reference index of system.ltx. With a cache directory it is saved next
+        to the snapshot and reused for as long as the snapshot is unchanged.
+        """
+        if self._xref:
+            return self._xref
+
+        ltx = self.ini_sys()
+        xref = None
+        cache_path = None
+        token = None
+
+        if self._ini_cache_dir:
+            snapshot_path = self.fresh_snapshot_path()
+
+            if snapshot_path is not None:
+                st = snapshot_path.stat()
+                token = (st.st_mtime_ns, st.st_size)
+                cache_path = self._ini_cache_dir / (self._cache_name("system.ltx") + "_xref.pickle")
+                xref = XrefIndex.load(cache_path, ltx, token)
+
+        if xref is None:
+            with self._phase("xref.build"):
+                xref = XrefIndex(ltx).build()
+
+            if cache_path:
+                xref.save(cache_path, token)
+
+        self._xref = xref
+        return xref
+
+    def query_engine(self):
+        """A query engine over system.ltx, whose key indexes are kept between queries"""
+        if not self._query:
+            self._query = LTXQueryEngine(self.ini_sys())
+
+        return self._query
+
+    def load_ini(self, path, workers=None):
+        path = self._real_path(Path("configs") / path)
+
+        if workers is None:
+            workers = self._workers
 
         if self._ini_cache_dir:
-            return self._load_ini_cached(path)
+            return self._load_ini_cached(path, workers=workers)
         else:
-            return self._load_ini(path)
+            return self._load_ini(path, workers=workers)
+
+    def section_index(self, path="system.ltx"):
+        """
+        The section index of an LTX file. With a cache directory it is saved there and
+        reused for as long as none of the indexed files changed.
+        """
+        path = self._real_path(Path("configs") / path)
+        index_path = None
+
+        if self._ini_cache_dir:
+            index_path = self._ini_cache_dir / Path(self._cache_name(path) + "_sections.pickle")
+            index = LTXSectionIndex.open(index_path, path, fs=self.fs)
+
+            if index is not None:
+                return index
+
+        log.info("Indexing sections of %s", path.name)
+        index = LTXSectionIndex(path, fs=self.fs).build()
+
+        if index_path:
+            index.save(index_path)
+
+        return index
+
+    def load_sections(self, names, path="system.ltx"):
+        """
+        Load only the given sections of an LTX file and their ancestors, parsing just the
+        parts of the files which define them. Returns an LTXFileRoot.
+        """
+        return self.section_index(path).load(names, compact=self._compact)
 
-    def _load_ini(self, path):
-        ltx = pystalker.gamedata.ltx.LTXFileRoot(path)
-        ltx.parse()
+    def _load_ini(self, path, workers=None):
+        ltx = pystalker.gamedata.ltx.LTXFileRoot(path, compact=self._compact, fs=self.fs)
+        ltx.parse(workers=workers, stats=self._stats)
         return ltx
 
-    def _load_ini_cached(self, path):
+    def snapshot_path(self, path="system.ltx"):
+        """The path of the snapshot of an LTX file in the cache directory, or None without one"""
+        if not self._ini_cache_dir:
+            return None
+
+        return self._ini_cache_dir / Path(self._cache_name(path) + ".snapshot")
+
+    def fresh_snapshot_path(self, path="system.ltx"):
+        """
+        The path of the snapshot of an LTX file if it was loaded or written by this instance,
+        and so holds exactly the sections it returned, otherwise None
+        """
+        snapshot_path = self.snapshot_path(path)
+        return snapshot_path if snapshot_path in self._fresh_snapshots else None
+
+    def _load_ini_cached(self, path, workers=None):
         path = Path(path)
 
-        base_name = path.name.replace(".", "_")
-        cache_name = self._ini_cache_dir / Path(base_name + "_" + hashlib.md5(open(path, 'rb').read()).hexdigest())
+        base_name = self._cache_name(path)
+        snapshot_path = self.snapshot_path(path)
 
-        if cache_name.exists():
-            ltx = pickle.load(open(cache_name, 'rb'))
-            return ltx
-        else:
-            ltx = self._load_ini(path)
-            pickle.dump(ltx, open(cache_name, 'wb'))
+        # Fast path: the built section graph, valid while none of its files changed
+        if snapshot_path.exists():
+            try:
+                with self._phase("ltx.snapshot"):
+                    if self._lazy:
+                        snapshot = LTXSnapshot.from_mmap(snapshot_path)
+                    else:
+                        snapshot = LTXSnapshot.from_file(snapshot_path)
+
+                    if snapshot.meta["root"] == str(path) and is_snapshot_fresh(snapshot.meta["depends"]):
+                        log.info("Loading %s from snapshot", path.name)
+                        self._fresh_snapshots.add(snapshot_path)
+
+                        if self._lazy:
+                            return snapshot.load_lazy(compact=self._compact)
+
+                        return snapshot.load(compact=self._compact)
+            except (LTXSnapshotError, OSError) as e:
+                log.info("Ignoring snapshot %s: %s", snapshot_path, e)
+
+        # Per-file parse trees for everything reached from this root. Only files
+        # which changed since the last load are parsed again.
+        tree_cache = FileCache(self._ini_cache_dir / Path(base_name + "_trees.pickle"),
+                pystalker.gamedata.ltx.parse_ltx_file)
+        tree_cache.load()
+
+        ltx = pystalker.gamedata.ltx.LTXFileRoot(path, compact=self._compact, fs=self.fs)
+        ltx.parse(tree_cache=tree_cache, workers=workers, stats=self._stats)
+
+        log.info("LTX tree cache: %d files reused, %d parsed", tree_cache.hits, tree_cache.misses)
+        self._count_cache("ltx.tree_cache", tree_cache)
+
+        with self._phase("ltx.cache_write"):
+            tree_cache.save()
+
+            self._fresh_snapshots.discard(snapshot_path)
+
+            try:
+                write_snapshot(ltx, snapshot_path, depends=self._snapshot_depends(tree_cache))
+                self._fresh_snapshots.add(snapshot_path)
+            except (LTXSnapshotError, OSError) as e:
+                log.warning("Unable to write snapshot of %s: %s", path.name, e)
 
         return ltx
 
-    def string_table(self, lang="eng"):
+    def _snapshot_depends(self, tree_cache):
+        # Every parsed file, as it was when parsed, plus the directories includes were resolved in
+        return collect_depends(((path, mtime, size, tree_cache.lookup(path))
+                for path, (mtime, size, _) in tree_cache.manifest().items()), fs=self.fs)
+
+    def _xml_cache(self, name):
+        # Parsed XML files share the cache directory with the LTX caches
+        if not self._ini_cache_dir:
+            return None
+
+        cache = FileCache(self._ini_cache_dir / Path(name + ".pickle"))
+        cache.load()
+        return cache
+
+    def string_table(self, lang="eng", executor=None):
         if lang in self._string_table:
             return self._string_table[lang]
 
-        stg = pystalker.gamedata.string_table.StringTableGroup(self.gamebase / "configs/text" / lang)
-        stg.walk()
+        cache = self._xml_cache("text_" + lang)
+
+        with self._phase("xml.string_table"):
+            if self.fs is not None:
+                stg = pystalker.gamedata.string_table.StringTableGroup(Path("configs/text") / lang, fs=self.fs)
+            else:
+                stg = pystalker.gamedata.string_table.StringTableGroup(self.gamebase / "configs/text" / lang)
+            stg.walk(workers=self._workers, processes=self._processes, executor=executor, cache=cache, stats=self._stats)
+
+            if cache is not None:
+                cache.save()
+
+        self._count_cache("xml.string_table_cache", cache)
 
         self._string_table[lang] = stg
         return stg
 
+    def string_tables(self, langs=None):
+        """
+        Load the string tables of several languages (all of them by default), sharing
+        one worker pool between them when parallel loading is enabled.
+        Returns {lang: StringTableGroup}.
+        """
+        if langs is None:
+            if self.fs is not None:
+                langs = [name for name in self.fs.listdir("configs/text") if self.fs.is_dir("configs/text/" + name)]
+            else:
+                langs = sorted(p.name for p in (self.gamebase / "configs/text").iterdir() if p.is_dir())
+
+        if self._workers is None:
+            return {lang: self.string_table(lang) for lang in langs}
+
+        pool_type = ProcessPoolExecutor if self._processes else ThreadPoolExecutor
+
+        with pool_type(max_workers=self._workers or None) as pool:
+            return {lang: self.string_table(lang, executor=pool) for lang in langs}
+
     def st_lookup(self, key, lang="eng"):
         return self.string_table(lang=lang).lookup(key)
 
+    def texture_descriptions(self):
+        if self._texture_descriptions:
+            return self._texture_descriptions
+
+        cache = self._xml_cache("textures_descr")
+
+        with self._phase("xml.texture_descriptions"):
+            if self.fs is not None:
+                tdg = pystalker.gamedata.texture_description.TextureDescriptionGroup("configs/ui/textures_descr", fs=self.fs)
+            else:
+                tdg = pystalker.gamedata.texture_description.TextureDescriptionGroup(self.gamebase / "configs/ui/textures_descr")
+            tdg.walk(workers=self._workers, processes=self._processes, cache=cache, stats=self._stats)
+
+            if cache is not None:
+                cache.save()
+
+        self._count_cache("xml.texture_description_cache", cache)
+
+        self._texture_descriptions = tdg
+        return tdg
+
+    def color_map(self, path="ui/color_defs.xml"):
+        cache = self._xml_cache("color_map_" + str(PureWindowsPath(path)).replace("\\", "_").replace(".", "_"))
+        with self._phase("xml.color_map"):
+            cmap = pystalker.gamedata.color_map.parse_color_map(self._real_path(Path("configs") / PureWindowsPath(path)), cache=cache)
+
+            if cache is not None:
+                cache.save()
+
+        self._count_cache("xml.color_map_cache", cache)
+
+        return cmap
+
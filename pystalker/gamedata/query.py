@@ -0,0 +1,393 @@
+import logging
+import re
+
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+"""
+Predicate queries over the resolved keys of an LTXFileRoot's sections, e.g.
+
+    class == WP_AK74 and cost > 5000 and name ~ wpn_*
+
+A comparison is a field, an operator and a value. The field is a key, or "name" for the
+section name (a key which is itself called name can be queried as key:name). Operators:
+
+    == =    equal, as a string or as a number. Matches any item of a list value
+    !=      has the key, but not equal
+    < <= > >=   numeric comparison
+    ~ !~    glob match (or no match) on the value, or on any item of a list value
+
+A field on its own matches sections which have the key. Comparisons are combined with
+and, or, not and parentheses. Values containing spaces or operators can be double quoted.
+
+Each key is indexed the first time it is queried, so repeated queries only pay for the
+sets they combine and not for a scan of every section.
+"""
+
+class LTXQueryError(Exception):
+    pass
+
+NAME_FIELD = "name"
+KEY_PREFIX = "key:"
+
+TOKEN = re.compile(r'\s*(?:(?P<op>==|!=|<=|>=|!~|[=<>~()])|"(?P<string>[^"]*)"|(?P<word>[^\s"=!<>~()]+))')
+COMPARISONS = {"==", "=", "!=", "<", "<=", ">", ">=", "~", "!~"}
+NUMERIC = {"<", "<=", ">", ">="}
+
+def _glob_prefix(pattern):
+    return re.split(r"[*?\[]", pattern, 1)[0]
+
+def _glob_sorted(items, pattern):
+    """Glob match over a sorted list, only testing the items sharing the pattern's literal prefix"""
+    prefix = _glob_prefix(pattern)
+
+    if prefix == pattern:
+        pos = bisect_left(items, pattern)
+        return items[pos:pos+1] if pos < len(items) and items[pos] == pattern else []
+
+    start = bisect_left(items, prefix)
+    end = bisect_left(items, prefix + "\U0010ffff") if prefix else len(items)
+
+    return [item for item in items[start:end] if fnmatchcase(item, pattern)]
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class _Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+
+        while pos < len(text):
+            m = TOKEN.match(text, pos)
+
+            if m is None or m.end() == pos:
+                if text[pos:].strip() == "":
+                    break
+
+                raise LTXQueryError("Unexpected %r at %d in query %r" % (text[pos:pos+10], pos, text))
+
+            if m.group("op") is not None:
+                self.tokens.append(("op", m.group("op")))
+            elif m.group("string") is not None:
+                self.tokens.append(("value", m.group("string")))
+            elif m.group("word") is not None:
+                word = m.group("word")
+
+                if word.lower() in ("and", "or", "not"):
+                    self.tokens.append(("op", word.lower()))
+                else:
+                    self.tokens.append(("value", word))
+
+            pos = m.end()
+
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect_value(self, what):
+        kind, value = self.next()
+
+        if kind != "value":
+            raise LTXQueryError("Expected %s in query %r" % (what, self.text))
+
+        return value
+
+    def parse(self):
+        if not self.tokens:
+            raise LTXQueryError("Empty query")
+
+        node = self.parse_or()
+
+        if self.pos != len(self.tokens):
+            raise LTXQueryError("Unexpected %r in query %r" % (self.peek()[1], self.text))
+
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+
+        while self.peek() == ("op", "or"):
+            self.next()
+            node = ("or", node, self.parse_and())
+
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+
+        while self.peek() == ("op", "and"):
+            self.next()
+            node = ("and", node, self.parse_not())
+
+        return node
+
+    def parse_not(self):
+        if self.peek() == ("op", "not"):
+            self.next()
+            return ("not", self.parse_not())
+
+        if self.peek() == ("op", "("):
+            self.next()
+            node = self.parse_or()
+
+            if self.next() != ("op", ")"):
+                raise LTXQueryError("Missing ) in query %r" % (self.text))
+
+            return node
+
+        field = self.expect_value("a key")
+        kind, op = self.peek()
+
+        if kind != "op" or op not in COMPARISONS:
+            return ("has", field)
+
+        self.next()
+        value = self.expect_value("a value after %s" % (op))
+
+        if op in NUMERIC and _to_number(value) is None:
+            raise LTXQueryError("%s requires a number, not %r" % (op, value))
+
+        return ("cmp", field, "==" if op == "=" else op, value)
+
+@lru_cache(maxsize=256)
+def parse_query(text):
+    """Parse a query into a tree of ("and"|"or", a, b), ("not", a), ("has", key) and ("cmp", key, op, value)"""
+    return _Parser(text).parse()
+
+class LTXKeyIndex:
+    """Inverted index of the resolved value of one key over every section"""
+
+    def __init__(self, key, sections):
+        self.key = key
+        self.values = {}
+        self.by_value = {}
+        numbers = []
+
+        for name, sec in sections.items():
+            value = sec.get_view(key)
+
+            if value is None:
+                continue
+
+            self.values[name] = value
+
+            if isinstance(value, tuple):
+                items = set(value)
+                items.add(",".join(value))
+            else:
+                items = (value,)
+                number = _to_number(value)
+
+                if number is not None:
+                    numbers.append((number, name))
+
+            for item in items:
+                self.by_value.setdefault(item, set()).add(name)
+
+        numbers.sort()
+        self.numbers = [n for n, _ in numbers]
+        self.number_names = [name for _, name in numbers]
+        self._sorted_values = None
+
+    def sorted_values(self):
+        if self._sorted_values is None:
+            self._sorted_values = sorted(self.by_value)
+
+        return self._sorted_values
+
+    def range(self, low=None, high=None, low_inclusive=True, high_inclusive=True):
+        """Returns the sections whose value is a number within the range"""
+        if low is None:
+            start = 0
+        else:
+            start = (bisect_left if low_inclusive else bisect_right)(self.numbers, low)
+
+        if high is None:
+            end = len(self.numbers)
+        else:
+            end = (bisect_right if high_inclusive else bisect_left)(self.numbers, high)
+
+        return set(self.number_names[start:end])
+
+    def equal(self, value):
+        result = set(self.by_value.get(value, ()))
+        number = _to_number(value)
+
+        if number is not None:
+            result |= self.range(number, number)
+
+        return result
+
+    def glob(self, pattern):
+        result = set()
+
+        for value in _glob_sorted(self.sorted_values(), pattern):
+            result |= self.by_value[value]
+
+        return result
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "<LTXKeyIndex %s: %d sections, %d values>" % (self.key, len(self.values), len(self.by_value))
+
+class LTXQueryEngine:
+    """
+    Runs queries (see parse_query) against the sections of an LTXFileRoot.
+
+    Indexes are built on first use of a key and kept until invalidate(), which
+    must be called after sections were added or changed.
+    """
+    def __init__(self, ltx):
+        self.ltx = ltx
+        self.indexes = {}
+        self._names = None
+        self._order = None
+
+    def invalidate(self):
+        self.indexes = {}
+        self._names = None
+        self._order = None
+
+    def key_index(self, key):
+        index = self.indexes.get(key)
+
+        if index is None:
+            index = self.indexes[key] = LTXKeyIndex(key, self.ltx.section)
+
+        return index
+
+    def sorted_names(self):
+        if self._names is None:
+            self._names = sorted(self.ltx.section.keys())
+
+        return self._names
+
+    def _all(self):
+        return set(self.sorted_names())
+
+    def _eval(self, node):
+        kind = node[0]
+
+        if kind == "and":
+            left = self._eval(node[1])
+            return left & self._eval(node[2]) if left else left
+        elif kind == "or":
+            return self._eval(node[1]) | self._eval(node[2])
+        elif kind == "not":
+            return self._all() - self._eval(node[1])
+        elif kind == "has":
+            if node[1] == NAME_FIELD:
+                return self._all()
+
+            return set(self.key_index(self._key(node[1])).values)
+
+        _, field, op, value = node
+
+        if field == NAME_FIELD:
+            return self._eval_name(op, value)
+
+        index = self.key_index(self._key(field))
+
+        if op == "==":
+            return index.equal(value)
+        elif op == "!=":
+            return set(index.values) - index.equal(value)
+        elif op == "~":
+            return index.glob(value)
+        elif op == "!~":
+            return set(index.values) - index.glob(value)
+
+        number = float(value)
+
+        if op == "<":
+            return index.range(high=number, high_inclusive=False)
+        elif op == "<=":
+            return index.range(high=number)
+        elif op == ">":
+            return index.range(low=number, low_inclusive=False)
+        else:
+            return index.range(low=number)
+
+    def _eval_name(self, op, value):
+        if op == "==":
+            return {value} if value in self.ltx.section else set()
+        elif op == "!=":
+            return self._all() - {value}
+        elif op == "~":
+            return set(_glob_sorted(self.sorted_names(), value))
+        elif op == "!~":
+            return self._all() - set(_glob_sorted(self.sorted_names(), value))
+
+        raise LTXQueryError("Cannot compare section names with %s" % (op))
+
+    @staticmethod
+    def _key(field):
+        return field[len(KEY_PREFIX):] if field.startswith(KEY_PREFIX) else field
+
+    def _ordered(self, names):
+        # Results are returned in the order of the section table
+        if self._order is None:
+            self._order = {name: i for i, name in enumerate(self.ltx.section.keys())}
+
+        return sorted(names, key=self._order.__getitem__)
+
+    def select(self, query=None):
+        """Returns the names of the sections matching query (all sections if None)"""
+        if query is None:
+            return list(self.ltx.section.keys())
+
+        return self._ordered(self._eval(parse_query(query)))
+
+    def select_names(self, pattern):
+        """Returns the names of the sections matching a glob, in load order"""
+        return self._ordered(_glob_sorted(self.sorted_names(), pattern))
+
+    def count(self, query=None, group_by=None, names=None):
+        """
+        Returns the number of matching sections, or with group_by, a list of (value, count)
+        for each resolved value of that key, most common first. List values are joined by commas.
+        names limits the count to those sections, for instance the result of select_names.
+        """
+        matched = self._all() if query is None else self._eval(parse_query(query))
+
+        if names is not None:
+            matched = matched.intersection(names)
+
+        if group_by is None:
+            return len(matched)
+
+        values = self.key_index(self._key(group_by)).values
+        counts = {}
+
+        # Counted in load order, so values with equal counts keep their first appearance order
+        for name in self._ordered(matched):
+            value = values.get(name)
+
+            if value is None:
+                continue
+
+            if isinstance(value, tuple):
+                value = ",".join(value)
+
+            counts[value] = counts.get(value, 0) + 1
+
+        return sorted(counts.items(), key=lambda x: x[1], reverse=True)
+
+    def __repr__(self):
+        return "<LTXQueryEngine %d indexed keys>" % (len(self.indexes))
@@ -0,0 +1,268 @@
+import logging
+import os
+import pickle
+import sys
+
+from pathlib import Path
+
+from .ltx import LTXFile, LTXFileRoot, LTXParseError, LTXSection, parse_ltx_data, resolve_includes
+from .snapshot import collect_depends, is_snapshot_fresh
+
+log = logging.getLogger(__name__)
+
+"""
+An index of where each section of an LTX include tree is defined, so that single sections
+can be loaded without parsing the whole tree.
+
+Every definition of a section is recorded in load order as (file, byte range, first line,
+parent names). A definition's parents are the definitions of those names which were current
+when it was declared, i.e. the last ones before it in load order. Loading a section through
+the index follows exactly these rules, so the result matches a full load.
+"""
+
+class LTXSectionIndex:
+    VERSION = 1
+
+    def __init__(self, ltx_root_path, fs=None):
+        self.root = Path(ltx_root_path)
+        # Includes are resolved through this LayeredFS when set
+        self.fs = fs
+        # [(path, encoding)] of each file defining sections
+        self.files = []
+        # name -> [(seq, file id, start, end, line, parents)] in load order
+        self.definitions = {}
+        # [(path, mtime_ns, size)] which must be unchanged for the index to be used
+        self.depends = []
+
+    def build(self):
+        file_ids = {}
+        scanned = {}
+        self.files = []
+        self.definitions = {}
+        self.depends = []
+        seq = 0
+
+        def walk(path):
+            nonlocal seq
+
+            # A file included more than once defines its sections again each time
+            if str(path) not in scanned:
+                st = path.stat()
+                scanned[str(path)] = self._scan(path) + (st.st_mtime_ns, st.st_size)
+
+            entries, encoding, _, _ = scanned[str(path)]
+
+            for entry in entries:
+                if entry[0] == "INCLUDE_PATH":
+                    for include in resolve_includes(path, entry[1], fs=self.fs):
+                        walk(include)
+
+                    continue
+
+                _, name, parents, start, end, line = entry
+                file_id = file_ids.get(str(path))
+
+                if file_id is None:
+                    file_id = file_ids[str(path)] = len(self.files)
+                    self.files.append((str(path), encoding))
+
+                self.definitions.setdefault(name, []).append((seq, file_id, start, end, line, tuple(parents)))
+                seq += 1
+
+        walk(self.root)
+        self.depends = collect_depends(((path, mtime, size, entries)
+                for path, (entries, _, mtime, size) in scanned.items()), fs=self.fs)
+
+        return self
+
+    @staticmethod
+    def _scan(path):
+        data = open(path, 'rb').read()
+        text, encoding = LTXFile.decode(data)
+        bom = 3 if encoding == "utf-8-sig" and data.startswith(b"\xef\xbb\xbf") else 0
+
+        locations = []
+        tree = parse_ltx_data(text, path, locations=locations)
+
+        # Convert character offsets to byte offsets, one gap at a time
+        byte_offsets = []
+        prev_char = 0
+        prev_byte = bom
+
+        for char_offset, _ in locations:
+            if encoding == "latin1":
+                prev_byte = char_offset
+            else:
+                prev_byte += len(text[prev_char:char_offset].encode("utf-8"))
+                prev_char = char_offset
+
+            byte_offsets.append(prev_byte)
+
+        byte_offsets.append(len(data))
+
+        entries = []
+        section = 0
+
+        for entry in tree:
+            if entry[0] == "SECTION":
+                entries.append(("SECTION", entry[1], entry[2],
+                    byte_offsets[section], byte_offsets[section+1], locations[section][1]))
+                section += 1
+            elif entry[0] == "INCLUDE_PATH":
+                entries.append(entry)
+
+        return entries, encoding
+
+    def is_fresh(self):
+        return is_snapshot_fresh(self.depends)
+
+    def __contains__(self, name):
+        return name in self.definitions
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def locate(self, name):
+        """Returns (path, start, end) of the final definition of a section, or None"""
+        defs = self.definitions.get(name)
+
+        if not defs:
+            return None
+
+        _, file_id, start, end, _, _ = defs[-1]
+        return self.files[file_id][0], start, end
+
+    def _definition(self, name, before):
+        # The last definition of name declared before seq before
+        for definition in reversed(self.definitions.get(name, ())):
+            if definition[0] < before:
+                return definition
+
+        return None
+
+    def load(self, names, compact=False):
+        """
+        Returns an LTXFileRoot holding the given sections and their ancestors, parsing only
+        the byte ranges which define them. The section table holds the sections whose
+        definition is the final one, in load order. Earlier definitions which are the parents
+        of loaded sections are only reachable through their parents.
+        """
+        needed = {}
+        pending = []
+
+        for name in names:
+            definition = self._definition(name, sys.maxsize)
+
+            if definition is None:
+                raise KeyError(name)
+
+            pending.append(definition)
+
+        # Collect the definitions of the whole ancestry
+        while pending:
+            definition = pending.pop()
+
+            if definition[0] in needed:
+                continue
+
+            needed[definition[0]] = definition
+
+            for parent in definition[5]:
+                parent_definition = self._definition(parent, definition[0])
+
+                if parent_definition is None:
+                    raise LTXParseError("Missing section %s" % (parent))
+
+                pending.append(parent_definition)
+
+        # Read the ranges of each file in one go
+        trees = {}
+        by_file = {}
+
+        for definition in needed.values():
+            by_file.setdefault(definition[1], []).append(definition)
+
+        for file_id, definitions in by_file.items():
+            path, encoding = self.files[file_id]
+            encoding = "utf-8" if encoding == "utf-8-sig" else encoding
+
+            with open(path, 'rb') as fp:
+                for seq, _, start, end, line, _ in sorted(definitions, key=lambda d: d[2]):
+                    fp.seek(start)
+                    text = fp.read(end - start).decode(encoding)
+                    trees[seq] = parse_ltx_data(text, Path(path), first_line=line)
+
+        ltx = LTXFileRoot(self.root, compact=compact, fs=self.fs)
+        ltx._values = {} if compact else None
+        ltx_files = {}
+        built = {}
+
+        # Ancestors always come before their children in load order
+        for seq in sorted(needed):
+            _, file_id, _, _, _, parents = needed[seq]
+
+            if file_id not in ltx_files:
+                ltx_files[file_id] = LTXFile(Path(self.files[file_id][0]))
+
+            sec_parents = [built[self._definition(parent, seq)[0]] for parent in parents]
+            sec = self._build(ltx, trees[seq], sec_parents)
+            sec.set_declaration_info(ltx_files[file_id])
+            built[seq] = sec
+
+            if self.definitions[sec.name][-1][0] == seq:
+                ltx.section[sec.name] = sec
+
+        ltx._values = None
+        return ltx
+
+    @staticmethod
+    def _build(ltx, tree, parents):
+        sec = None
+
+        for entry in tree:
+            if entry[0] == "SECTION":
+                name = sys.intern(entry[1]) if ltx.compact else entry[1]
+                sec = LTXSection(name, parents)
+            elif entry[0] == "ASSIGN":
+                ltx._assign(sec, *entry[1:])
+
+        return sec
+
+    def save(self, path):
+        tmp_path = Path(str(path) + ".tmp")
+
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump({
+                "version": self.VERSION,
+                "root": str(self.root),
+                "files": self.files,
+                "definitions": self.definitions,
+                "depends": self.depends,
+            }, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path, ltx_root_path, fs=None):
+        """Load a saved index of ltx_root_path, or return None if it is missing, unreadable or stale"""
+        try:
+            with open(path, 'rb') as fp:
+                data = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Discarding unreadable section index %s: %s", path, e)
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION or data.get("root") != str(ltx_root_path):
+            return None
+
+        index = cls(ltx_root_path, fs=fs)
+        index.files = data["files"]
+        index.definitions = data["definitions"]
+        index.depends = data["depends"]
+
+        return index if index.is_fresh() else None
+
+    def __repr__(self):
+        return "<LTXSectionIndex %s, %d sections, %d files>" % (self.root.name, len(self.definitions), len(self.files))
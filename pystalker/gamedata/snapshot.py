@@ -0,0 +1,628 @@
+import gc
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from array import array
+from collections.abc import Mapping
+from itertools import islice
+from operator import sub
+from pathlib import Path
+
+from .ltx import LTXFile, LTXFileRoot, LTXSection, include_watch_dirs
+
+log = logging.getLogger(__name__)
+
+"""
+A versioned binary snapshot of a built LTXFileRoot section graph.
+
+Unlike a pickle, a snapshot only contains plain data, so it is not tied to the layout of the
+Python classes and is considerably faster to load. A snapshot which fails to decode raises
+LTXSnapshotError, so a damaged one is simply rebuilt.
+
+Layout (all integers little-endian unless stored in an array, which uses the byte order in the header):
+
+    header      MAGIC, VERSION, byte order, CRC-32 of everything after it, then the (offset, length)
+                of each 4-byte aligned block
+    META        UTF-8 JSON: root path and the files/directories the snapshot depends on
+    STRINGS     every distinct string, UTF-8 encoded and separated by NUL
+    STRING_IDX  u32 byte offset of each string in STRINGS, plus the end offset
+    FILES       u32 string index of each file a section was declared in
+    KEYS        u32 (type, value) pair of each distinct key: a string index or an integer
+    VALUES      u32 string indices of the items of every list value, concatenated
+    VALUE_IDX   u32 offset of each list in VALUES, plus the end offset
+    NAMES       u32 string index of the name of each section record
+    RECORD_FILES u32 file index of each record, or NONE
+    PARENT_IDX  u32 offset of the parents of each record in PARENTS, plus the end offset
+    PARENTS     u32 record indices of the parents of every record, in order
+    KEY_IDX     u32 offset of the keys of each record in KEY_IDS and VALUE_IDS, plus the end offset
+    KEY_IDS     u32 key index of every key of every record
+    VALUE_IDS   u32 value of every key of every record: a string index, the number of strings
+                for None, or the number of strings plus one plus a list index. Every list is
+                the value of exactly one key, so a full load can hand each key its own list.
+    TABLE       u32 record index of each entry of LTXFileRoot.section, in order
+    NAME_INDEX  u32 positions in TABLE, sorted by the UTF-8 bytes of the section name
+
+Records are stored column by column, parents always before their children, so a full load
+streams each column once. Overwritten sections which are still parents of other sections
+are kept as records.
+
+Every block can be used in-place, so a snapshot can also be memory-mapped and its sections
+decoded one at a time as they are accessed (see open_snapshot).
+"""
+
+MAGIC = b"PYSTLKR\x00"
+VERSION = 4
+
+BLOCKS = ("META", "STRINGS", "STRING_IDX", "FILES", "KEYS", "VALUES", "VALUE_IDX", "NAMES",
+        "RECORD_FILES", "PARENT_IDX", "PARENTS", "KEY_IDX", "KEY_IDS", "VALUE_IDS", "TABLE", "NAME_INDEX")
+PREAMBLE = struct.Struct("<8sIB3x")
+CHECKSUM = struct.Struct("<I4x")
+LAYOUT = struct.Struct("<" + "QQ" * len(BLOCKS))
+HEADER_SIZE = PREAMBLE.size + CHECKSUM.size + LAYOUT.size
+
+NONE = 0xFFFFFFFF
+
+KEY_STR = 0
+KEY_INT = 1
+
+# Marks list and None value ids in the writer until the number of strings is known
+_LIST_VALUE = 0x80000000
+
+class LTXSnapshotError(Exception):
+    pass
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+
+    def add(self, string):
+        idx = self.index.get(string)
+
+        if idx is None:
+            if "\0" in string:
+                raise LTXSnapshotError("Cannot store string containing NUL: %r" % (string))
+
+            idx = len(self.index)
+            self.index[string] = idx
+
+        return idx
+
+    def encode(self):
+        blob = bytearray()
+        offsets = array('I')
+
+        for string in self.index:
+            offsets.append(len(blob))
+            blob += string.encode("utf-8")
+            blob += b"\0"
+
+        offsets.append(len(blob))
+        return bytes(blob), offsets
+
+def write_snapshot(ltx, path, depends=()):
+    """
+    Write the section graph of ltx to path.
+
+    depends is a list of (path, mtime_ns, size) which must all be unchanged for the
+    snapshot to be considered fresh (see is_snapshot_fresh).
+    """
+    strings = _StringTable()
+    files = {}
+    file_table = array('I')
+
+    key_of = {}
+    key_table = array('I')
+    value_table = array('I')
+    value_idx = array('I')
+
+    names = array('I')
+    record_files = array('I')
+    parent_idx = array('I')
+    parent_ids = array('I')
+    key_idx = array('I')
+    key_ids = array('I')
+    value_ids = array('I')
+    record_of = {}
+    ltx_names = list(ltx.section.keys())
+
+    def add_key(key):
+        key_id = key_of.get(key)
+
+        if key_id is None:
+            if isinstance(key, str):
+                key_table.extend((KEY_STR, strings.add(key)))
+            elif isinstance(key, int) and 0 <= key < NONE:
+                key_table.extend((KEY_INT, key))
+            else:
+                raise LTXSnapshotError("Unsupported key %r in section %s" % (key, sec.name))
+
+            key_id = key_of[key] = len(key_of)
+
+        return key_id
+
+    def add_value(value):
+        if isinstance(value, str):
+            return strings.add(value)
+
+        if value is None:
+            return _LIST_VALUE
+
+        if not isinstance(value, (list, tuple)) or not all(isinstance(v, str) for v in value):
+            raise LTXSnapshotError("Unsupported value %r in section %s" % (value, sec.name))
+
+        value_idx.append(len(value_table))
+        value_table.extend(map(strings.add, value))
+
+        return _LIST_VALUE | len(value_idx)
+
+    # Parents must be decoded before their children
+    for sec in ltx.records():
+        record_of[id(sec)] = len(names)
+
+        if sec.defined_in is None:
+            file_id = NONE
+        else:
+            file_key = str(sec.defined_in.path)
+            file_id = files.get(file_key)
+
+            if file_id is None:
+                file_id = files[file_key] = len(file_table)
+                file_table.append(strings.add(file_key))
+
+        names.append(strings.add(sec.name))
+        record_files.append(file_id)
+        parent_idx.append(len(parent_ids))
+        parent_ids.extend(record_of[id(parent)] for parent in sec.parents)
+        key_idx.append(len(key_ids))
+        key_ids.extend(map(add_key, sec.keys.keys()))
+        value_ids.extend(map(add_value, sec.keys.values()))
+
+    if len(strings.index) >= _LIST_VALUE:
+        raise LTXSnapshotError("Too many strings")
+
+    # None and the list values are numbered after the strings
+    n_strings = len(strings.index)
+    value_ids = array('I', (v if v < _LIST_VALUE else n_strings + (v ^ _LIST_VALUE) for v in value_ids))
+
+    value_idx.append(len(value_table))
+    parent_idx.append(len(parent_ids))
+    key_idx.append(len(key_ids))
+    table = array('I', (record_of[id(sec)] for sec in ltx.section.values()))
+    name_index = array('I', sorted(range(len(table)), key=lambda i: ltx_names[i].encode("utf-8")))
+
+    string_blob, string_idx = strings.encode()
+    meta = {
+        "root": str(ltx.ltx_root.path),
+        "depends": [list(d) for d in depends],
+    }
+
+    blocks = [
+        json.dumps(meta).encode("utf-8"),
+        string_blob,
+        string_idx.tobytes(),
+        file_table.tobytes(),
+        key_table.tobytes(),
+        value_table.tobytes(),
+        value_idx.tobytes(),
+        names.tobytes(),
+        record_files.tobytes(),
+        parent_idx.tobytes(),
+        parent_ids.tobytes(),
+        key_idx.tobytes(),
+        key_ids.tobytes(),
+        value_ids.tobytes(),
+        table.tobytes(),
+        name_index.tobytes(),
+    ]
+
+    offset = HEADER_SIZE
+    layout = []
+
+    for i, block in enumerate(blocks):
+        # keep every block 4-byte aligned so u32 arrays can be used in-place
+        if len(block) % 4:
+            block = blocks[i] = block + b"\0" * (4 - len(block) % 4)
+
+        layout += [offset, len(block)]
+        offset += len(block)
+
+    byteorder = 0 if sys.byteorder == "little" else 1
+    layout = LAYOUT.pack(*layout)
+    checksum = zlib.crc32(layout)
+
+    for block in blocks:
+        checksum = zlib.crc32(block, checksum)
+
+    tmp_path = Path(str(path) + ".tmp")
+
+    with open(tmp_path, 'wb') as fp:
+        fp.write(PREAMBLE.pack(MAGIC, VERSION, byteorder))
+        fp.write(CHECKSUM.pack(checksum))
+        fp.write(layout)
+
+        for block in blocks:
+            fp.write(block)
+
+    os.replace(tmp_path, path)
+
+class LTXSnapshot:
+    """Random access reader over the blocks of a snapshot held in a buffer"""
+
+    def __init__(self, data):
+        self.data = data
+
+        if len(data) < PREAMBLE.size:
+            raise LTXSnapshotError("Truncated snapshot")
+
+        magic, version, byteorder = PREAMBLE.unpack_from(data, 0)
+
+        if magic != MAGIC:
+            raise LTXSnapshotError("Not a pystalker snapshot")
+
+        if version != VERSION:
+            raise LTXSnapshotError("Snapshot version %d, expected %d" % (version, VERSION))
+
+        if byteorder != (0 if sys.byteorder == "little" else 1):
+            raise LTXSnapshotError("Snapshot was written with a different byte order")
+
+        if len(data) < HEADER_SIZE:
+            raise LTXSnapshotError("Truncated snapshot")
+
+        # Checked up front, so a lazily decoded snapshot can't fail halfway through a lookup
+        checksum, = CHECKSUM.unpack_from(data, PREAMBLE.size)
+
+        if zlib.crc32(memoryview(data)[PREAMBLE.size+CHECKSUM.size:]) != checksum:
+            raise LTXSnapshotError("Snapshot checksum mismatch")
+
+        self.blocks = {}
+        layout = LAYOUT.unpack_from(data, PREAMBLE.size + CHECKSUM.size)
+
+        for i, name in enumerate(BLOCKS):
+            offset, length = layout[i*2:i*2+2]
+
+            if offset < HEADER_SIZE or offset + length > len(data):
+                raise LTXSnapshotError("Truncated snapshot block %s" % (name))
+
+            self.blocks[name] = (offset, length)
+
+        try:
+            self.meta = json.loads(bytes(self.block("META")).rstrip(b"\0").decode("utf-8"))
+        except ValueError as e:
+            raise LTXSnapshotError("Corrupt snapshot metadata: %s" % (e))
+
+        if not isinstance(self.meta, dict) or not isinstance(self.meta.get("root"), str) or \
+                not isinstance(self.meta.get("depends"), list) or \
+                not all(isinstance(d, list) and len(d) == 3 for d in self.meta["depends"]):
+            raise LTXSnapshotError("Corrupt snapshot metadata")
+
+    def block(self, name):
+        offset, length = self.blocks[name]
+        return memoryview(self.data)[offset:offset+length]
+
+    def u32_block(self, name):
+        block = self.block(name)
+
+        if self.blocks[name][0] % 4 or len(block) % 4:
+            raise LTXSnapshotError("Misaligned snapshot block %s" % (name))
+
+        return block.cast('I')
+
+    def strings(self):
+        count = len(self.u32_block("STRING_IDX")) - 1
+
+        try:
+            return bytes(self.block("STRINGS")).decode("utf-8").split("\0", count)[:count]
+        except UnicodeDecodeError as e:
+            raise LTXSnapshotError("Corrupt snapshot strings: %s" % (e))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as fp:
+            return cls(fp.read())
+
+    @classmethod
+    def from_mmap(cls, path):
+        with open(path, 'rb') as fp:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise LTXSnapshotError("Unable to map %s: %s" % (path, e))
+
+        return cls(data)
+
+    def load_lazy(self, compact=False):
+        ltx = LTXFileRoot(self.meta["root"], compact=compact)
+        ltx.section = LTXLazySections(self, compact=compact)
+        return ltx
+
+    def keys(self, strings):
+        table = self.u32_block("KEYS").tolist()
+        return [strings[v] if ty == KEY_STR else v for ty, v in zip(table[0::2], table[1::2])]
+
+    def values(self, strings, compact=False):
+        """
+        Every value, as numbered in VALUE_IDS: the strings, None, then the lists. As when
+        parsing, compact lists are tuples shared between equal values.
+        """
+        table = self.u32_block("VALUES")
+        value_idx = self.u32_block("VALUE_IDX").tolist()
+
+        if not value_idx or value_idx[0] != 0 or value_idx[-1] != len(table):
+            raise LTXSnapshotError("Corrupt snapshot: inconsistent value table")
+
+        items = list(map(strings.__getitem__, table))
+        lists = map(items.__getitem__, map(slice, value_idx, value_idx[1:]))
+        values = strings + [None]
+
+        if compact:
+            shared = {}
+            lists = list(map(tuple, lists))
+            values.extend(map(shared.setdefault, lists, lists))
+        else:
+            values.extend(lists)
+
+        return values
+
+    def load(self, compact=False):
+        # Nothing decoded here can be garbage, so don't let the collector
+        # repeatedly scan the growing graph
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            return self._load(compact)
+        except (IndexError, KeyError, TypeError, ValueError, struct.error) as e:
+            raise LTXSnapshotError("Corrupt snapshot: %s: %s" % (type(e).__name__, e))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load(self, compact):
+        strings = self.strings()
+
+        if compact:
+            strings = list(map(sys.intern, strings))
+
+        files = [LTXFile(Path(strings[i])) for i in self.u32_block("FILES")]
+        keys = self.keys(strings)
+        values = self.values(strings, compact)
+        parent_idx = self.u32_block("PARENT_IDX").tolist()
+        key_idx = self.u32_block("KEY_IDX").tolist()
+        key_ids = self.u32_block("KEY_IDS")
+        value_ids = self.u32_block("VALUE_IDS")
+        n_records = len(self.u32_block("NAMES"))
+
+        # The columns are streamed, so check up front that they line up
+        if len(self.u32_block("RECORD_FILES")) != n_records or len(parent_idx) != n_records + 1 or \
+                len(key_idx) != n_records + 1 or parent_idx[0] != 0 or key_idx[0] != 0 or \
+                parent_idx[-1] != len(self.u32_block("PARENTS")) or key_idx[-1] != len(key_ids) or \
+                len(value_ids) != len(key_ids):
+            raise LTXSnapshotError("Corrupt snapshot: inconsistent record columns")
+
+        sections = self._load_records(strings, files, keys, values, parent_idx, key_idx)
+
+        ltx = LTXFileRoot(self.meta["root"], compact=compact)
+        ltx.section = {sections[i].name: sections[i] for i in self.u32_block("TABLE")}
+
+        return ltx
+
+    def _load_records(self, strings, files, keys, values, parent_idx, key_idx):
+        # Every column is consumed by one iterator, so the loop only slices off each record's share
+        sections = []
+        append = sections.append
+        parent_it = map(sections.__getitem__, self.u32_block("PARENTS"))
+        key_it = map(keys.__getitem__, self.u32_block("KEY_IDS"))
+        value_it = map(values.__getitem__, self.u32_block("VALUE_IDS"))
+
+        for name, file_id, n_parents, n_keys in zip(map(strings.__getitem__, self.u32_block("NAMES")),
+                self.u32_block("RECORD_FILES"), map(sub, parent_idx[1:], parent_idx), map(sub, key_idx[1:], key_idx)):
+            sec = LTXSection(name, list(islice(parent_it, n_parents)))
+
+            if file_id != NONE:
+                sec.set_declaration_info(files[file_id])
+
+            sec.keys = dict(zip(islice(key_it, n_keys), islice(value_it, n_keys)))
+            append(sec)
+
+        return sections
+
+class LTXLazySections(Mapping):
+    """
+    The section table of a snapshot, decoding each section the first time it is accessed.
+
+    Decoding a section also decodes its parent chain. Every record is decoded at most once,
+    so parent links are shared exactly as in a full load. The table is read-only.
+    """
+    def __init__(self, snapshot, compact=False):
+        self.snapshot = snapshot
+        self.compact = compact
+
+        self._strings = snapshot.block("STRINGS")
+        self._string_idx = snapshot.u32_block("STRING_IDX")
+        self._files = snapshot.u32_block("FILES")
+        self._keys = snapshot.u32_block("KEYS")
+        self._values = snapshot.u32_block("VALUES")
+        self._value_idx = snapshot.u32_block("VALUE_IDX")
+        self._names = snapshot.u32_block("NAMES")
+        self._record_files = snapshot.u32_block("RECORD_FILES")
+        self._parent_idx = snapshot.u32_block("PARENT_IDX")
+        self._parents = snapshot.u32_block("PARENTS")
+        self._key_idx = snapshot.u32_block("KEY_IDX")
+        self._key_ids = snapshot.u32_block("KEY_IDS")
+        self._value_ids = snapshot.u32_block("VALUE_IDS")
+        self._table = snapshot.u32_block("TABLE")
+        self._name_index = snapshot.u32_block("NAME_INDEX")
+        self._n_strings = len(self._string_idx) - 1
+
+        self._string_cache = {}
+        self._file_cache = {}
+        self._shared_values = {}
+        self._decoded = {}
+
+    def _string_bytes(self, string_id):
+        # strings are NUL terminated in the blob
+        return bytes(self._strings[self._string_idx[string_id]:self._string_idx[string_id+1]-1])
+
+    def _string(self, string_id):
+        string = self._string_cache.get(string_id)
+
+        if string is None:
+            string = self._string_bytes(string_id).decode("utf-8")
+
+            if self.compact:
+                string = sys.intern(string)
+
+            self._string_cache[string_id] = string
+
+        return string
+
+    def _file(self, file_id):
+        ltx_file = self._file_cache.get(file_id)
+
+        if ltx_file is None:
+            ltx_file = self._file_cache[file_id] = LTXFile(Path(self._string(self._files[file_id])))
+
+        return ltx_file
+
+    def _key(self, key_id):
+        ty, value = self._keys[key_id*2], self._keys[key_id*2+1]
+        return self._string(value) if ty == KEY_STR else value
+
+    def _value(self, value_id):
+        if value_id < self._n_strings:
+            return self._string(value_id)
+
+        if value_id == self._n_strings:
+            return None
+
+        list_id = value_id - self._n_strings - 1
+        start, end = self._value_idx[list_id], self._value_idx[list_id+1]
+        value = list(map(self._string, self._values[start:end]))
+
+        if self.compact:
+            value = tuple(value)
+            value = self._shared_values.setdefault(value, value)
+
+        return value
+
+    def _record(self, record_id):
+        sec = self._decoded.get(record_id)
+
+        if sec is not None:
+            return sec
+
+        start, end = self._parent_idx[record_id], self._parent_idx[record_id+1]
+        parents = [self._record(p) for p in self._parents[start:end]]
+
+        sec = LTXSection(self._string(self._names[record_id]), parents)
+        file_id = self._record_files[record_id]
+
+        if file_id != NONE:
+            sec.set_declaration_info(self._file(file_id))
+
+        start, end = self._key_idx[record_id], self._key_idx[record_id+1]
+        sec.keys = dict(zip(map(self._key, self._key_ids[start:end]), map(self._value, self._value_ids[start:end])))
+
+        self._decoded[record_id] = sec
+        return sec
+
+    def _find(self, name):
+        if not isinstance(name, str):
+            return None
+
+        target = name.encode("utf-8")
+        name_index = self._name_index
+        lo, hi = 0, len(name_index)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._name_bytes(name_index[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(name_index) and self._name_bytes(name_index[lo]) == target:
+            return self._table[name_index[lo]]
+
+        return None
+
+    def _name_bytes(self, table_pos):
+        return self._string_bytes(self._names[self._table[table_pos]])
+
+    def __getitem__(self, name):
+        record_id = self._find(name)
+
+        if record_id is None:
+            raise KeyError(name)
+
+        return self._record(record_id)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __iter__(self):
+        for record_id in self._table:
+            yield self._string(self._names[record_id])
+
+    def __len__(self):
+        return len(self._table)
+
+    def values(self):
+        return [self._record(record_id) for record_id in self._table]
+
+    def items(self):
+        return [(sec.name, sec) for sec in self.values()]
+
+    def decoded(self):
+        """Returns the number of sections decoded so far"""
+        return len(self._decoded)
+
+    def __repr__(self):
+        return "<LTXLazySections %d sections, %d decoded>" % (len(self), self.decoded())
+
+def open_snapshot(path, compact=False):
+    """Map a snapshot and return an LTXFileRoot whose sections are decoded on demand"""
+    return LTXSnapshot.from_mmap(path).load_lazy(compact=compact)
+
+def is_snapshot_fresh(depends):
+    for path, mtime, size in depends:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if st.st_mtime_ns != mtime or (size >= 0 and st.st_size != size):
+            return False
+
+    return True
+
+def collect_depends(files, fs=None):
+    """
+    The depends of a snapshot or index built from parsed files. files yields (path, mtime_ns,
+    size, tree) of each file, and the directories its include directives were resolved in
+    are added, so that files added to or removed from a glob are noticed.
+    """
+    depends = []
+    include_dirs = set()
+
+    for path, mtime, size, tree in files:
+        depends.append((str(path), mtime, size))
+
+        for entry in tree:
+            if entry[0] == "INCLUDE_PATH":
+                include_dirs.update(include_watch_dirs(path, entry[1], fs=fs))
+
+    for include_dir in sorted(include_dirs):
+        depends.append((str(include_dir), include_dir.stat().st_mtime_ns, -1))
+
+    return depends
+
+def read_snapshot(path, compact=False):
+    """Load a snapshot written by write_snapshot into a new LTXFileRoot"""
+    return LTXSnapshot.from_file(path).load(compact=compact)
@@ -0,0 +1,175 @@
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+"""
+Opt-in load statistics. A LoadStats passed to the loaders (or to StalkerGameData.set_stats)
+collects the time and, optionally, traced memory of each load phase, per-file read and
+parse timings, token counts and include fan-out, and cache hit/miss counters.
+"""
+
+class FileStats:
+    __slots__ = ("path", "kind", "size", "read", "parse", "tokens", "includes")
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.size = 0
+        # Seconds spent reading the file and lexing/parsing it
+        self.read = 0.0
+        self.parse = 0.0
+        self.tokens = 0
+        self.includes = 0
+
+    @property
+    def total(self):
+        return self.read + self.parse
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "<FileStats %s, %.3fs, tokens=%d, includes=%d>" % (self.path, self.total, self.tokens, self.includes)
+
+class PhaseStats:
+    __slots__ = ("name", "calls", "seconds", "peak_memory")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        # Peak bytes allocated above the start of the phase, when memory is traced
+        self.peak_memory = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "<PhaseStats %s, %.3fs>" % (self.name, self.seconds)
+
+class LoadStats:
+    """
+    Statistics of one or more loads. With trace_memory, the peak memory of every phase
+    is measured with tracemalloc, which slows loading down considerably.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.files = {}
+        self.counters = {}
+        self._memory_stack = []
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of loading. Phases may nest, and repeated phases accumulate"""
+        stats = self.phases.get(name)
+
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+
+        tracing = self.trace_memory
+
+        if tracing:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._memory_stack.append(None)
+            elif self._memory_stack and self._memory_stack[-1] is not None:
+                # Resetting the peak below would lose the enclosing phase's peak so far
+                self._memory_stack[-1][1] = max(self._memory_stack[-1][1], tracemalloc.get_traced_memory()[1])
+
+            # [memory at start, highest peak of nested phases]
+            frame = [tracemalloc.get_traced_memory()[0], 0]
+            self._memory_stack.append(frame)
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            stats.calls += 1
+
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+                self._memory_stack.pop()
+                stats.peak_memory = max(stats.peak_memory or 0, peak - frame[0])
+
+                if self._memory_stack and self._memory_stack[-1] is None:
+                    self._memory_stack.pop()
+                    tracemalloc.stop()
+                elif self._memory_stack:
+                    self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+
+    def file(self, path, kind):
+        """The FileStats of path, created on first use"""
+        key = str(path)
+        stats = self.files.get(key)
+
+        if stats is None:
+            stats = self.files[key] = FileStats(key, kind)
+
+        return stats
+
+    def add_file(self, file_stats):
+        """Merge a FileStats collected elsewhere, for instance in a worker process"""
+        stats = self.file(file_stats.path, file_stats.kind)
+        stats.size = file_stats.size
+        stats.read += file_stats.read
+        stats.parse += file_stats.parse
+        stats.tokens += file_stats.tokens
+        stats.includes = max(stats.includes, file_stats.includes)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def slowest(self, n=10, kind=None):
+        files = [f for f in self.files.values() if kind is None or f.kind == kind]
+        return sorted(files, key=lambda f: f.total, reverse=True)[:n]
+
+    def time_split(self):
+        """Returns {"io": seconds, "parse": seconds, "build": seconds} summed over all files"""
+        build = self.phases.get("ltx.build")
+
+        return {
+            "io": sum(f.read for f in self.files.values()),
+            "parse": sum(f.parse for f in self.files.values()),
+            "build": build.seconds if build else 0.0,
+        }
+
+    def as_dict(self):
+        return {
+            "phases": [p.as_dict() for p in self.phases.values()],
+            "files": [f.as_dict() for f in self.files.values()],
+            "counters": dict(self.counters),
+            "time_split": self.time_split(),
+        }
+
+    def report(self, n=10):
+        lines = ["Phases:"]
+
+        for p in self.phases.values():
+            memory = "" if p.peak_memory is None else "  peak %.1f MiB" % (p.peak_memory / (1024*1024))
+            lines.append("  %-24s %8.3fs  x%d%s" % (p.name, p.seconds, p.calls, memory))
+
+        split = self.time_split()
+        lines.append("Time split: io %.3fs, lex/parse %.3fs, build %.3fs" % (split["io"], split["parse"], split["build"]))
+
+        if self.files:
+            lines.append("Slowest files (of %d, %.1f MiB):" % (len(self.files),
+                sum(f.size for f in self.files.values()) / (1024*1024)))
+
+            for f in self.slowest(n):
+                lines.append("  %8.3fs  io %.3fs  %7d tokens  %3d includes  %s" % (f.total, f.read, f.tokens, f.includes, f.path))
+
+        if self.counters:
+            lines.append("Counters:")
+
+            for name, value in sorted(self.counters.items()):
+                lines.append("  %-32s %d" % (name, value))
+
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "<LoadStats phases=%d, files=%d>" % (len(self.phases), len(self.files))
@@ -1,48 +1,73 @@
-import re
-import glob
 import logging
-import xml.etree.ElementTree as ET
-from functools import lru_cache
 from pathlib import Path
-from .xml_file import StalkerXmlFile
+from .xml_file import StalkerXmlFile, load_xml_files
 
 log = logging.getLogger(__name__)
 
 class StringTableGroup:
-    def __init__(self, base_path):
+    """
+    All string table files of one language, merged into a single id to text index.
+
+    Files are loaded in sorted order. As in the engine, an id defined in more than one
+    file takes the text of the last one (override="last"). override="first" keeps the
+    text of the first file instead.
+
+    With a LayeredFS, base_path is a virtual directory and the tables of every layer are loaded.
+    """
+    OVERRIDES = ("first", "last")
+
+    def __init__(self, base_path, override="last", fs=None):
+        if override not in self.OVERRIDES:
+            raise ValueError("override must be one of %s" % (", ".join(self.OVERRIDES)))
+
         self.base_path = Path(base_path)
+        self.override = override
+        self.fs = fs
         self.table = {}
+        self.index = {}
 
-    @lru_cache
     def lookup(self, key):
-        for t in self.table.values():
-            if key in t.entry:
-                return t.entry[key]
-
-    def walk(self):
-        table_files = list(map(Path, sorted(glob.glob(str(self.base_path / "*.xml")))))
-
-        for table_file in table_files:
-            st = StringTableFile(table_file)
-            try:
-                st.parse()
-                self.table[table_file] = st
-            except ET.ParseError as e:
-                log.warning("Failed to parse %s: %s", table_file, e)
-                pass
+        return self.index.get(key)
+
+    def lookup_many(self, keys):
+        """Returns the text of each id in keys, or None where it is missing"""
+        return list(map(self.index.get, keys))
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _merge(self, st):
+        if self.override == "last":
+            self.index.update(st.entry)
+        else:
+            for st_id, value in st.entry.items():
+                self.index.setdefault(st_id, value)
+
+    def walk(self, workers=None, processes=False, executor=None, cache=None, stats=None):
+        """
+        Parse every table file, optionally concurrently (see load_xml_files).
+        With a FileCache, only files which changed since they were cached are parsed.
+        Per-file timings and cache hits are recorded in stats, a LoadStats.
+        """
+        self.index = {}
+
+        # Merged in sorted file order, so the result is deterministic
+        for table_file, st in load_xml_files(StringTableFile, self.base_path, fs=self.fs, workers=workers,
+                processes=processes, executor=executor, cache=cache, stats=stats):
+            self.table[table_file] = st
+            self._merge(st)
 
 class StringTableFile(StalkerXmlFile):
 
-    def __init__(self, path):
+    def __init__(self, path, entry=None):
         super().__init__(path)
-        self.entry = {}
+        self.entry = {} if entry is None else entry
 
     def parse(self):
-        tree = super().parse()
-        root = tree.getroot()
-
-        assert root.tag == "string_table"
-        for st in root:
+        for st in self.iterchildren(root_tag="string_table"):
             assert st.tag == "string"
             st_id = st.attrib['id']
 
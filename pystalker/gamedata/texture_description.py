@@ -1,16 +1,16 @@
-import glob
 import logging
-import xml.etree.ElementTree as ET
 from functools import lru_cache
 from pathlib import Path, PureWindowsPath
-from .xml_file import StalkerXmlFile
+from .xml_file import StalkerXmlFile, load_xml_files
 
 
 log = logging.getLogger(__name__)
 
 class TextureDescriptionGroup:
-    def __init__(self, base_path):
+    def __init__(self, base_path, fs=None):
+        # With a LayeredFS, base_path is a virtual directory
         self.base_path = Path(base_path)
+        self.fs = fs
         self.files = {}
 
     @lru_cache
@@ -19,23 +19,21 @@ class TextureDescriptionGroup:
             if key in t.entry:
                 return t.entry[key]
 
-    def walk(self):
-        files = list(map(Path, sorted(glob.glob(str(self.base_path / "*.xml")))))
-
-        for fname in files:
-            obj = TextureDescriptionFile(fname)
-            try:
-                obj.parse()
-                self.files[fname] = obj
-            except ET.ParseError as e:
-                log.warning("Failed to parse %s: %s", fname, e)
-                pass
+    def walk(self, workers=None, processes=False, executor=None, cache=None, stats=None):
+        """
+        Parse every texture description file, optionally concurrently (see load_xml_files).
+        With a FileCache, only files which changed since they were cached are parsed.
+        Per-file timings and cache hits are recorded in stats, a LoadStats.
+        """
+        for fname, obj in load_xml_files(TextureDescriptionFile, self.base_path, fs=self.fs, workers=workers,
+                processes=processes, executor=executor, cache=cache, stats=stats):
+            self.files[fname] = obj
 
 class TextureDescriptionFile(StalkerXmlFile):
 
-    def __init__(self, path):
+    def __init__(self, path, entry=None):
         super().__init__(path)
-        self.entry = {}
+        self.entry = {} if entry is None else entry
 
     def get(self, key):
         return self.entry[key]
@@ -44,12 +42,7 @@ class TextureDescriptionFile(StalkerXmlFile):
         return self.entry.items()
 
     def parse(self):
-        tree = super().parse()
-        root = tree.getroot()
-
-        assert root.tag == "w"
-
-        for tfile in root:
+        for tfile in self.iterchildren(root_tag="w"):
             for tex in tfile:
                 info = {'path': PureWindowsPath(tfile.attrib["name"])}
                 tname = tex.attrib["id"]
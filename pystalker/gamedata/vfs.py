@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import posixpath
+
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePosixPath, PureWindowsPath
+
+log = logging.getLogger(__name__)
+
+"""
+A layered, case-insensitive view of several game data roots, as Mod Organizer presents
+mod folders over the base game.
+
+Every root is walked once when the filesystem is built. A file in a later root overrides
+the file with the same path (ignoring case) in earlier roots. Lookups and globs are then
+answered from the in-memory index, without touching the disk.
+
+Virtual paths are relative to the roots, e.g. configs/system.ltx, with either separator.
+"""
+
+def _key(path):
+    """The lower case index key of a virtual path, or None if it climbs above the roots"""
+    key = posixpath.normpath(str(PurePosixPath(PureWindowsPath(path))).lower().strip("/"))
+
+    if key == ".." or key.startswith("../"):
+        return None
+
+    return "" if key == "." else key
+
+class LayeredFS:
+    def __init__(self, roots):
+        self.roots = [Path(root) for root in roots]
+        # lower case virtual path -> real path of the topmost file
+        self.files = {}
+        # lower case virtual directory -> {lower case name: real path} of the files in it
+        self.dirs = {}
+        # real path -> lower case virtual path
+        self.virtual = {}
+
+    @classmethod
+    def from_mo2(cls, gamebase, mods_dir, modlist):
+        """
+        Layer the enabled mods of a Mod Organizer profile over gamebase. modlist.txt lists
+        mods highest priority first, with a + before enabled mods.
+        """
+        mods = []
+
+        with open(modlist, encoding="utf-8-sig") as fp:
+            for line in fp:
+                line = line.strip()
+
+                if line.startswith("+"):
+                    mods.append(Path(mods_dir) / line[1:])
+
+        return cls([gamebase] + mods[::-1])
+
+    def build(self):
+        self.files = {}
+        self.dirs = {}
+        self.virtual = {}
+
+        for root in self.roots:
+            if not root.is_dir():
+                log.warning("Missing VFS root %s", root)
+                continue
+
+            pending = [(root, "")]
+
+            while pending:
+                real_dir, virtual_dir = pending.pop()
+                entries = self.dirs.setdefault(virtual_dir, {})
+
+                with os.scandir(real_dir) as it:
+                    for entry in it:
+                        name = entry.name.lower()
+                        virtual = virtual_dir + "/" + name if virtual_dir else name
+
+                        if entry.is_dir():
+                            pending.append((Path(entry.path), virtual))
+                            continue
+
+                        old = self.files.get(virtual)
+
+                        if old is not None:
+                            del self.virtual[old]
+
+                        real = Path(entry.path)
+                        self.files[virtual] = real
+                        self.virtual[real] = virtual
+                        entries[name] = real
+
+        log.info("Indexed %d files in %d directories of %d roots", len(self.files), len(self.dirs), len(self.roots))
+        return self
+
+    def layers_id(self):
+        """A short id of the list of roots, for naming caches of this layering"""
+        return hashlib.md5("\n".join(map(str, self.roots)).encode("utf-8")).hexdigest()[:12]
+
+    def resolve(self, path):
+        """Returns the real path of a virtual file, or None if no layer has it"""
+        return self.files.get(_key(path))
+
+    def exists(self, path):
+        return _key(path) in self.files
+
+    def is_dir(self, path):
+        return _key(path) in self.dirs
+
+    def virtual_path(self, real_path):
+        """Returns the virtual path of a real file in the index, or None"""
+        return self.virtual.get(Path(real_path))
+
+    def listdir(self, path):
+        """Returns the lower case names of the files and directories in a virtual directory"""
+        key = _key(path)
+
+        if key is None:
+            return []
+
+        names = set(self.dirs.get(key, ()))
+        prefix = key + "/" if key else ""
+
+        for dir_key in self.dirs:
+            if dir_key.startswith(prefix) and dir_key != key and "/" not in dir_key[len(prefix):]:
+                names.add(dir_key[len(prefix):])
+
+        return sorted(names)
+
+    def glob(self, pattern):
+        """
+        Returns the real paths of the files matching a virtual glob, sorted by virtual path.
+        Wildcards are matched against the file name only, ignoring case.
+        """
+        key = _key(pattern)
+
+        if key is None:
+            return []
+
+        virtual_dir, _, name_pattern = key.rpartition("/")
+
+        return [real for name, real in sorted(self.dirs.get(virtual_dir, {}).items())
+                if fnmatchcase(name, name_pattern)]
+
+    def watch_dirs(self, path):
+        """
+        The real directories whose mtimes change when files are added to or removed from a
+        virtual directory in any layer: the directory itself in each layer which has it,
+        otherwise its deepest ancestor which does exist.
+        """
+        key = _key(path)
+
+        if key is None:
+            return []
+
+        parts = key.split("/") if key else []
+        result = []
+
+        for root in self.roots:
+            real = root
+
+            for part in parts:
+                child = self._find_child(real, part)
+
+                if child is None:
+                    break
+
+                real = child
+
+            if real.is_dir():
+                result.append(real)
+
+        return result
+
+    @staticmethod
+    def _find_child(real_dir, name):
+        try:
+            with os.scandir(real_dir) as it:
+                for entry in it:
+                    if entry.name.lower() == name and entry.is_dir():
+                        return Path(entry.path)
+        except OSError:
+            pass
+
+        return None
+
+    def __contains__(self, path):
+        return self.exists(path)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __repr__(self):
+        return "<LayeredFS %d roots, %d files>" % (len(self.roots), len(self.files))
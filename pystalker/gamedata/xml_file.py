@@ -1,16 +1,28 @@
+import os
 import re
+import glob
+import time
 import xml.etree.ElementTree as ET
 import logging
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from pathlib import Path
 
 log = logging.getLogger(__name__)
 
 class StalkerXmlFile:
-    COMMENT = re.compile(rb'<!--.*?-->', re.MULTILINE | re.DOTALL)
+    """
+    STALKER's XML files are not standard compliant: comments may appear anywhere and
+    ampersands are never escaped. The file is streamed through a filter which strips
+    comments and escapes every '&', chunk by chunk, before it reaches the XML parser.
+    """
     BARE_AMP = re.compile(rb'&')
+    CHUNK_SIZE = 64 * 1024
 
     def __init__(self, path):
         self.path = path
+        # Seconds spent reading the file while it was streamed
+        self.read_time = 0.0
 
     def read(self):
         return open(self.path, 'rb').read()
@@ -21,18 +33,188 @@ class StalkerXmlFile:
         except UnicodeDecodeError:
             return data.decode("latin1")
 
+    def read_chunks(self):
+        """Yields the file contents with comments removed and ampersands escaped"""
+        in_comment = False
+        data = b''
+
+        with open(self.path, 'rb') as fp:
+            while True:
+                start = time.perf_counter()
+                chunk = fp.read(self.CHUNK_SIZE)
+                self.read_time += time.perf_counter() - start
+                data += chunk
+                out = []
+                pos = 0
+
+                while True:
+                    if in_comment:
+                        end = data.find(b'-->', pos)
+
+                        if end == -1:
+                            # keep what could be the start of a split '-->'
+                            pos = max(pos, len(data) - 2)
+                            break
+
+                        pos = end + 3
+                        in_comment = False
+                    else:
+                        start = data.find(b'<!--', pos)
+
+                        if start == -1:
+                            # keep what could be the start of a split '<!--'
+                            end = len(data) if not chunk else max(pos, len(data) - 3)
+                            out.append(data[pos:end])
+                            pos = end
+                            break
+
+                        out.append(data[pos:start])
+                        pos = start + 4
+                        in_comment = True
+
+                data = data[pos:]
+                out = b''.join(out)
+
+                if out:
+                    yield self.BARE_AMP.sub(b'&amp;', out)
+
+                if not chunk:
+                    break
+
+        if in_comment:
+            raise ET.ParseError("unclosed comment in %s" % (self.path))
+
+    def iterparse(self, events=("end",)):
+        parser = ET.XMLPullParser(events=events)
+
+        for chunk in self.read_chunks():
+            parser.feed(chunk)
+            yield from parser.read_events()
+
+        parser.close()
+        yield from parser.read_events()
+
+    def iterchildren(self, root_tag=None):
+        """
+        Stream the file, yielding each complete direct child of the root element.
+        Children are dropped from the tree once the caller moves on, so memory stays
+        proportional to a single child rather than the whole document.
+        """
+        log.info("Parsing %s", self.path)
+
+        depth = 0
+        root = None
+
+        for event, elem in self.iterparse(events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                    assert root_tag is None or root.tag == root_tag
+
+                depth += 1
+            else:
+                depth -= 1
+
+                if depth == 1:
+                    yield elem
+                    root.remove(elem)
+
     def parse(self):
         log.info("Parsing %s", self.path)
 
-        # Strip comments as they are not XML standard compliant...
-        data = BytesIO(
-            self.BARE_AMP.sub(
-                b'&amp;',
-                self.COMMENT.sub(b'', self.read())
-            )
-        )
+        parser = ET.XMLParser()
 
-        return ET.parse(data)
+        for chunk in self.read_chunks():
+            parser.feed(chunk)
+
+        return ET.ElementTree(parser.close())
 
     def __repr__(self):
         return "<StalkerXmlFile %s>" % (self.path)
+
+def _parse_xml_file(cls, path):
+    obj = cls(path)
+    start = time.perf_counter()
+
+    try:
+        obj.parse()
+    except ET.ParseError as e:
+        return path, None, str(e), (time.perf_counter() - start, obj.read_time)
+
+    return path, obj, None, (time.perf_counter() - start, obj.read_time)
+
+def _map_xml_files(cls, paths, workers, processes, executor):
+    if executor is not None:
+        yield from executor.map(_parse_xml_file, repeat(cls), paths)
+    elif workers is not None:
+        pool_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+        with pool_type(max_workers=workers or None) as pool:
+            yield from pool.map(_parse_xml_file, repeat(cls), paths)
+    else:
+        for path in paths:
+            yield _parse_xml_file(cls, path)
+
+def parse_xml_files(cls, paths, workers=None, processes=False, executor=None, stats=None):
+    """
+    Parse each of paths as a cls (a StalkerXmlFile), yielding (path, parsed file, error)
+    in the same order as paths. The parsed file is None when the XML is malformed.
+
+    Files are parsed concurrently when workers is given (0 uses one per CPU), in threads
+    or, with processes, in worker processes. An existing executor may be passed instead.
+    The read and parse time of every file is recorded in stats, a LoadStats.
+    """
+    for path, obj, error, (seconds, read_time) in _map_xml_files(cls, paths, workers, processes, executor):
+        if stats is not None:
+            file_stats = stats.file(path, "xml")
+            file_stats.size = os.path.getsize(path)
+            file_stats.read += read_time
+            file_stats.parse += seconds - read_time
+
+        yield path, obj, error
+
+def load_xml_files(cls, base_path, fs=None, workers=None, processes=False, executor=None, cache=None, stats=None):
+    """
+    Load every *.xml file in base_path (a virtual directory of fs, a LayeredFS, when given)
+    as a cls, returning [(path, parsed file)] in sorted path order. Files which fail to
+    parse are logged and left out.
+
+    cls keeps its parse results in entry and can be created from them as cls(path, entry).
+    With a FileCache, only files which changed since they were cached are parsed, the rest
+    are created from their cached entry. Parsing is as in parse_xml_files.
+    """
+    if fs is not None:
+        paths = fs.glob(Path(base_path) / "*.xml")
+    else:
+        paths = list(map(Path, sorted(glob.glob(str(Path(base_path) / "*.xml")))))
+
+    cached = {}
+
+    if cache is not None:
+        for path in paths:
+            entry = cache.lookup(path)
+
+            if entry is not None:
+                cached[path] = cls(path, entry)
+
+    parsed = parse_xml_files(cls, [path for path in paths if path not in cached],
+            workers=workers, processes=processes, executor=executor, stats=stats)
+    parsed = {path: (obj, error) for path, obj, error in parsed}
+    result = []
+
+    for path in paths:
+        if path in cached:
+            obj = cached[path]
+        else:
+            obj, error = parsed[path]
+
+            if obj is None:
+                log.warning("Failed to parse %s: %s", path, error)
+                continue
+
+            if cache is not None:
+                cache.put(path, obj.entry)
+
+        result.append((path, obj))
+
+    return result
@@ -0,0 +1,194 @@
+import logging
+import os
+import pickle
+
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# The "key" recorded when a section references another by inheriting from it
+PARENT = None
+
+def _value_refs(value):
+    if isinstance(value, str):
+        return (value,)
+    elif isinstance(value, (list, tuple)):
+        return value
+
+    return ()
+
+class XrefIndex:
+    """
+    Cross references between the sections of an LTXFileRoot.
+
+    Maps every referenced value (section names, string table ids or any other value)
+    to the sections which reference it, either by inheriting from it or through one of
+    their keys. Only each section's own keys are indexed. Sections which merely inherit a
+    reference are found at query time by following the children of the referencing section.
+
+    Every section reachable from the section table is indexed, including overwritten
+    sections which are still parents, so sections are keyed by object rather than name.
+    Only sections in the table are reported.
+    """
+    VERSION = 2
+
+    def __init__(self, ltx):
+        self.ltx = ltx
+        self.refs = {}
+        self.uses = {}
+        self.parents = {}
+        self.children = {}
+
+    def build(self):
+        self.refs = {}
+        self.uses = {}
+        self.parents = {}
+        self.children = {}
+
+        for sec in self.ltx.records():
+            self._add(sec)
+
+        return self
+
+    def _add(self, sec):
+        uses = self.uses.setdefault(sec, set())
+        self.parents[sec] = tuple(sec.parents)
+
+        for parent in sec.parents:
+            self.children.setdefault(parent, set()).add(sec)
+            self._add_ref(parent.name, sec, PARENT)
+            uses.add(parent.name)
+
+        for key, value in sec.keys.items():
+            for target in _value_refs(value):
+                self._add_ref(target, sec, key)
+                uses.add(target)
+
+    def _add_ref(self, target, sec, key):
+        keys = self.refs.setdefault(target, {}).setdefault(sec, [])
+
+        if key not in keys:
+            keys.append(key)
+
+    def _in_table(self, sec):
+        return self.ltx.section.get(sec.name) is sec
+
+    def remove_section(self, sec):
+        """Drop a section from the index, e.g. one which was overwritten and is no longer a parent"""
+        for target in self.uses.pop(sec, ()):
+            referrers = self.refs.get(target)
+
+            if referrers is None:
+                continue
+
+            referrers.pop(sec, None)
+
+            if not referrers:
+                del self.refs[target]
+
+        for parent in self.parents.pop(sec, ()):
+            children = self.children.get(parent)
+
+            if children is not None:
+                children.discard(sec)
+
+                if not children:
+                    del self.children[parent]
+
+    def update_section(self, sec):
+        """Re-index a section after it was added, changed or redefined"""
+        self.remove_section(sec)
+        self._add(sec)
+
+    def __contains__(self, target):
+        return target in self.refs
+
+    def direct_referrers(self, target):
+        """Returns {section name: [keys]} of the sections whose own keys (or parents) reference target"""
+        return {sec.name: keys for sec, keys in self.refs.get(target, {}).items() if self._in_table(sec)}
+
+    def referrers(self, target, inherited=True):
+        """
+        Returns the names of the sections referencing target. With inherited, sections
+        which inherit a referencing key without overriding it are included as well.
+        """
+        result = set()
+
+        for sec, keys in self.refs.get(target, {}).items():
+            if self._in_table(sec):
+                result.add(sec.name)
+
+            if not inherited:
+                continue
+
+            keys = [k for k in keys if k is not PARENT]
+            pending = [(child, keys) for child in self.children.get(sec, ())] if keys else []
+
+            while pending:
+                child, keys = pending.pop()
+                resolved = child.get_all_view()
+                keys = [k for k in keys if target in _value_refs(resolved.get(k))]
+
+                if keys:
+                    if self._in_table(child):
+                        result.add(child.name)
+
+                    pending.extend((grandchild, keys) for grandchild in self.children.get(child, ()))
+
+        return result
+
+    def save(self, path, token=None):
+        # Sections are saved as their position in ltx.records(), which is the same
+        # for every load of the same files
+        number = {sec: i for i, sec in enumerate(self.ltx.records())}
+        tmp_path = Path(str(path) + ".tmp")
+
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump({
+                "version": self.VERSION,
+                "token": token,
+                "refs": {target: {number[sec]: keys for sec, keys in referrers.items() if sec in number}
+                        for target, referrers in self.refs.items()},
+                "uses": {number[sec]: targets for sec, targets in self.uses.items() if sec in number},
+                "parents": {number[sec]: [number[p] for p in parents if p in number]
+                        for sec, parents in self.parents.items() if sec in number},
+            }, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, ltx, token=None):
+        """Load a saved index for ltx, or return None if it is missing, unreadable or for another token"""
+        try:
+            with open(path, 'rb') as fp:
+                data = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Discarding unreadable xref index %s: %s", path, e)
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != cls.VERSION or data.get("token") != token:
+            return None
+
+        records = ltx.records()
+        index = cls(ltx)
+
+        try:
+            index.refs = {target: {records[i]: keys for i, keys in referrers.items()}
+                    for target, referrers in data["refs"].items()}
+            index.uses = {records[i]: targets for i, targets in data["uses"].items()}
+            index.parents = {records[i]: tuple(map(records.__getitem__, parents))
+                    for i, parents in data["parents"].items()}
+        except (IndexError, KeyError, AttributeError, TypeError) as e:
+            log.warning("Discarding unreadable xref index %s: %s", path, e)
+            return None
+
+        for sec, parents in index.parents.items():
+            for parent in parents:
+                index.children.setdefault(parent, set()).add(sec)
+
+        return index
+
+    def __repr__(self):
+        return "<XrefIndex %d targets, %d sections>" % (len(self.refs), len(self.uses))
@@ -0,0 +1,170 @@
+import os
+import json
+import signal
+import socket
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+"""
+A resident query server, keeping the game data loaded between queries.
+
+The protocol is the batch mode's over a Unix domain socket: the client writes one query
+per line and reads back one JSON object per line, in order. Any number of clients are
+served concurrently, but their queries are answered one at a time in a single worker thread:
+the event loop stays free to accept clients and poll for changes during a slow query, and
+the lazily built indexes and caches of the handler are never touched by two queries at once.
+"""
+
+def tree_signature(paths):
+    """The (path, mtime, size) of every file and directory below paths, used to notice changes"""
+    signature = []
+
+    for top in paths:
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+
+            for name in [""] + sorted(files):
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+
+                signature.append((root, name, st.st_mtime_ns, st.st_size))
+
+    return hash(tuple(signature))
+
+class QueryServer:
+    """
+    Serve the QueryHandler returned by load on socket_path.
+
+    With watch, the files below those paths are polled every interval seconds and the
+    handler is replaced by a freshly loaded one when any changed. Queries keep being
+    answered from the old handler while the new one loads.
+    """
+    def __init__(self, load, socket_path, watch=None, interval=2.0):
+        self.load = load
+        self.socket_path = Path(socket_path)
+        self.watch = watch
+        self.interval = interval
+        self.handler = None
+        self.queries = 0
+        self._executor = None
+
+    def run(self):
+        # Fail before the (slow) initial load if another server owns the socket
+        self._remove_stale_socket()
+
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        signature = None
+
+        if self.watch:
+            signature = await loop.run_in_executor(None, tree_signature, self.watch)
+
+        self.handler = self.load()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query")
+
+        server = await asyncio.start_unix_server(self._client, path=str(self.socket_path))
+        log.info("Serving queries on %s", self.socket_path)
+
+        tasks = [asyncio.ensure_future(server.serve_forever())]
+
+        if self.watch:
+            tasks.append(asyncio.ensure_future(self._watch(signature)))
+
+        loop.add_signal_handler(signal.SIGTERM, lambda: [task.cancel() for task in tasks])
+
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            server.close()
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self.socket_path.unlink(missing_ok=True)
+            log.info("Served %d queries", self.queries)
+
+    def _remove_stale_socket(self):
+        if not self.socket_path.is_socket():
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(self.socket_path))
+            except ConnectionRefusedError:
+                self.socket_path.unlink()
+                return
+
+        raise OSError("A server is already listening on %s" % (self.socket_path))
+
+    async def _client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                query = line.decode("utf-8", "replace").strip()
+
+                if query == "":
+                    continue
+
+                self.queries += 1
+                # The handler in use when the query arrived answers it, even if a reload replaces it meanwhile
+                response = await loop.run_in_executor(self._executor, self.handler.run, query)
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _watch(self, signature):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await asyncio.sleep(self.interval)
+            current = await loop.run_in_executor(None, tree_signature, self.watch)
+
+            if current == signature:
+                continue
+
+            log.info("Game data changed, reloading")
+
+            try:
+                self.handler = await loop.run_in_executor(None, self.load)
+            except Exception:
+                log.exception("Reload failed, still serving the previous data")
+
+            # Changes made while reloading are picked up on the next poll
+            signature = current
+
+def query_server(socket_path, queries):
+    """Send each query to the server at socket_path, yielding each JSON response line as it arrives"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+
+        with sock.makefile("rwb") as fp:
+            for query in queries:
+                query = query.strip()
+
+                if query == "" or query.startswith("#"):
+                    continue
+
+                fp.write(query.encode("utf-8") + b"\n")
+                fp.flush()
+
+                yield fp.readline().decode("utf-8").rstrip("\n")